@@ -0,0 +1,281 @@
+# description: LINEレシピBotの非同期版エントリポイント。main.py と同じ動きを asyncio で行う。
+# 会話の流れは utils/conversation.py を main.py と共有し、ここには非同期のI/Oだけを置く。
+# 起動: uvicorn asgi:app --host 0.0.0.0 --port 8000
+# --workers で複数プロセスにするときは、METRICS_DIR を指定すると /metrics が全プロセスの合計になる。
+# GPT・LINEへの呼び出しはすべてコルーチンで、接続はキープアライブのプールを使い回す。
+# 1プロセスで数千件のGPT呼び出しを、スレッドを増やさずに同時に待てる。
+
+import os
+import time
+import random
+import asyncio
+from dotenv import load_dotenv
+from openai import AsyncOpenAI
+from linebot.v3 import WebhookParser
+from linebot.v3.exceptions import InvalidSignatureError
+from linebot.v3.messaging import (
+    AsyncApiClient, AsyncMessagingApi, Configuration,
+    ReplyMessageRequest, PushMessageRequest, TextMessage, FlexMessage, FlexContainer
+)
+from linebot.v3.webhooks import MessageEvent, TextMessageContent
+from utils.delivery import AsyncOutbox
+from utils.recipes import build_flex_bubble
+from utils.suggestion_cache import SuggestionCache
+from utils.recipe_store import RecipeStore
+from utils.session_store import open_store
+from utils.conversation import Conversation, BUSY_TEXT
+from utils import metrics
+
+load_dotenv()
+
+parser = WebhookParser(os.environ["LINE_CHANNEL_SECRET"])
+
+# LINE API の接続プールの大きさと、同時に処理するイベント数の上限
+# (AsyncOpenAI は標準で最大1000接続のキープアライブプールを持つのでそのまま使う)
+POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", "100"))
+MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "2000"))
+THINKING_DELAY = float(os.environ.get("THINKING_DELAY", "1.0"))
+
+openai_client = None
+line_api_client = None
+line_bot_api = None
+outbox = None
+conversation = None
+
+user_sessions = open_store("sessions", ttl=int(os.environ.get("SESSION_TTL", "86400")))
+suggestion_cache = SuggestionCache(
+    path=os.environ.get("SUGGESTION_CACHE_DB", "suggestion_cache.db"),
+    ttl=int(os.environ.get("SUGGESTION_CACHE_TTL", str(6 * 3600))),
+    max_entries=int(os.environ.get("SUGGESTION_CACHE_SIZE", "5000")),
+)
+recipe_store = RecipeStore(
+    path=os.environ.get("RECIPE_STORE_DB", "recipe_store.db"),
+    prewarm_top=int(os.environ.get("RECIPE_PREWARM_TOP", "20")),
+    prewarm_min_selections=int(os.environ.get("RECIPE_PREWARM_MIN_SELECTIONS", "3")),
+)
+# user_id -> [Lock, 待ち件数]。同じユーザーのイベントは届いた順に1件ずつ処理する
+_user_locks = {}
+_tasks = set()
+_prewarm_task = None
+
+metrics.register_stats("recipe_bot_suggestion_cache", suggestion_cache.stats)
+metrics.register_stats("recipe_bot_recipe_store", recipe_store.stats)
+
+
+async def startup():
+    global openai_client, line_api_client, line_bot_api, outbox, conversation, _prewarm_task
+    openai_client = AsyncOpenAI(api_key=os.environ["OPENAI_API_KEY"])
+    configuration = Configuration(
+        access_token=os.environ["LINE_CHANNEL_ACCESS_TOKEN"],
+        host=os.environ.get("LINE_API_ENDPOINT", "https://api.line.me"),
+    )
+    configuration.connection_pool_maxsize = POOL_SIZE
+    line_api_client = AsyncApiClient(configuration)
+    line_bot_api = AsyncMessagingApi(line_api_client)
+    # main.py と同じく、返信は reply token の期限を見て reply / push を選び、まとめて送る
+    outbox = AsyncOutbox(
+        reply=reply_messages,
+        push=push,
+        status_of=lambda e: getattr(e, "status", None),
+        workers=int(os.environ.get("LINE_SENDER_CONCURRENCY", str(POOL_SIZE))),
+    )
+    conversation = Conversation(
+        outbox, user_sessions, suggestion_cache, recipe_store,
+        text_message=lambda text: TextMessage(text=text),
+        flex_message=build_flex_message,
+        thinking_delay=THINKING_DELAY,
+    )
+    _prewarm_task = asyncio.create_task(prewarm_loop())
+
+
+async def drain(timeout=None):
+    if _tasks:
+        await asyncio.wait(list(_tasks), timeout=timeout)
+
+
+async def shutdown():
+    # 処理中のイベントと溜まった返信を送り切ってから接続を閉じる
+    _prewarm_task.cancel()
+    timeout = float(os.environ.get("GRACEFUL_TIMEOUT", "60"))
+    await drain(timeout=timeout)
+    await outbox.drain(timeout=timeout)
+    await openai_client.close()
+    await line_api_client.close()
+
+
+def dispatch(body, signature):
+    with metrics.stage("verify_signature"):
+        events = parser.parse(body, signature)
+    for event in events:
+        if not isinstance(event, MessageEvent) or not isinstance(event.message, TextMessageContent):
+            continue
+        if len(_tasks) >= MAX_INFLIGHT:
+            metrics.ERRORS.inc(where="queue_full")
+            coro = reply_busy(event)
+        else:
+            coro = run_for_user(event.source.user_id, handle_message, event, time.perf_counter())
+        task = asyncio.create_task(coro)
+        _tasks.add(task)
+        task.add_done_callback(_tasks.discard)
+
+
+async def run_for_user(user_id, func, event, received):
+    entry = _user_locks.get(user_id)
+    if entry is None:
+        entry = _user_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            with metrics.trace(event=event.type):
+                # 同じユーザーの前のイベントを待った時間
+                metrics.observe("queue_wait", time.perf_counter() - received)
+                await func(event)
+    except Exception as e:
+        print(f"❌ イベント処理でエラー発生: {e}")
+        metrics.ERRORS.inc(where="event")
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del _user_locks[user_id]
+
+
+async def reply_messages(reply_token, messages):
+    with metrics.stage("line_reply"):
+        await line_bot_api.reply_message(ReplyMessageRequest(reply_token=reply_token, messages=messages))
+
+
+async def reply_text(reply_token, text):
+    await reply_messages(reply_token, [TextMessage(text=text)])
+
+
+async def push(user_id, messages, retry_key=None):
+    with metrics.stage("line_push"):
+        await line_bot_api.push_message(
+            PushMessageRequest(to=user_id, messages=messages), x_line_retry_key=retry_key
+        )
+
+
+async def reply_busy(event):
+    try:
+        await reply_text(event.reply_token, BUSY_TEXT)
+    except Exception as e:
+        print(f"❌ LINE送信エラー: {e}")
+        metrics.ERRORS.inc(where="line")
+
+
+def build_flex_message(user_msg, recipes):
+    return FlexMessage(
+        alt_text="レシピの提案です",
+        contents=FlexContainer.from_dict(build_flex_bubble(user_msg, recipes))
+    )
+
+
+async def generate_detail(title):
+    async with conversation.detail_call(title) as call:
+        with metrics.stage("openai_detail"):
+            call.reply = await openai_client.chat.completions.create(**call.request)
+    return call.content()
+
+
+async def prewarm_loop():
+    # main.py の RecipeStore.start_prewarm と同じことをイベントループ上で行う
+    if recipe_store.prewarm_top <= 0:
+        return
+    while True:
+        await asyncio.sleep(recipe_store.prewarm_interval * random.uniform(0.5, 1.5))
+        for title in await asyncio.to_thread(recipe_store.titles_to_prewarm):
+            try:
+                await recipe_store.aget_or_create(
+                    title, generate_detail, refresh_before=recipe_store.refresh_before
+                )
+            except Exception as e:
+                print(f"❌ プリウォーム失敗: {title}: {e}")
+
+
+async def handle_message(event):
+    user_id = event.source.user_id
+    user_msg = event.message.text.strip()
+    outbox.register(user_id, event.reply_token, event.timestamp / 1000)
+
+    # セッション・利用回数・予算・キャッシュはSQLiteに書き、他のワーカーとロックを取り合うことがある。
+    # イベントループを止めないよう、書き込みのある呼び出しはすべて別スレッドで行う
+    kind, title = await asyncio.to_thread(conversation.begin, user_id, user_msg)
+    if kind == "detail":
+        try:
+            recipe = await recipe_store.aget_or_create(title, generate_detail)
+        except Exception as e:
+            await asyncio.to_thread(conversation.detail_failed, user_id, e)
+        else:
+            await asyncio.to_thread(conversation.send_detail, user_id, title, recipe)
+    elif kind == "suggest":
+        turn = conversation.suggestion_turn(user_id, user_msg)
+        try:
+            request = await asyncio.to_thread(turn.request)
+            stream = await openai_client.chat.completions.create(**request)
+            async for chunk in stream:
+                if turn.feed(chunk):
+                    await asyncio.to_thread(turn.push_early)
+            await asyncio.to_thread(turn.finish)
+        except Exception as e:
+            await asyncio.to_thread(turn.fail, e)
+        finally:
+            await asyncio.to_thread(turn.settle)
+
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get("body", b""))
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+async def respond(send, status, text, content_type=b"text/plain; charset=utf-8"):
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type)],
+    })
+    await send({"type": "http.response.body", "body": text.encode("utf-8")})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            await startup()
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            await shutdown()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def app(scope, receive, send):
+    if scope["type"] == "lifespan":
+        await lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    if scope["path"] == "/metrics" and scope["method"] == "GET":
+        await respond(send, 200, metrics.render(), b"text/plain; version=0.0.4; charset=utf-8")
+        return
+    if scope["path"] != "/callback" or scope["method"] != "POST":
+        await respond(send, 404, "Not Found")
+        return
+
+    start = time.perf_counter()
+    headers = dict(scope["headers"])
+    signature = headers.get(b"x-line-signature", b"").decode("utf-8")
+    body = (await read_body(receive)).decode("utf-8")
+    try:
+        dispatch(body, signature)
+    except InvalidSignatureError:
+        print("❌ Invalid signature")
+        metrics.ERRORS.inc(where="signature")
+        await respond(send, 400, "Bad Request")
+        return
+    metrics.observe("webhook", time.perf_counter() - start)
+    await respond(send, 200, "OK")
@@ -0,0 +1,169 @@
+# スレッド版(main.py)と asyncio 版(asgi.py)の処理速度・メモリを、ローカルの代用サーバー相手に比べる。
+# python bench/bench_async.py --events 2000 --latency 0.5 --workers 64
+# モードごとに別プロセスで動かすので、最大メモリ(ru_maxrss)がそのまま比べられる。
+
+import argparse
+import asyncio
+import json
+import os
+import resource
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+
+from webhook import signed_body, text_event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "bench-secret"
+
+
+def make_webhooks(n):
+    return [
+        signed_body(SECRET, [text_event(f"U{i:032x}", "暑くて疲れた", f"R{i}", f"E{i}")])
+        for i in range(n)
+    ]
+
+
+def run_threaded(bodies, timeout):
+    import main
+
+    done = threading.Event()
+    lock = threading.Lock()
+    finished = [0]
+    shed = [0]
+
+    def count(func, shed_event=False):
+        # キューが満杯で断ったイベントも、処理し終えたものとして数える
+        def counted(event):
+            try:
+                func(event)
+            finally:
+                with lock:
+                    finished[0] += 1
+                    shed[0] += shed_event
+                    if finished[0] == len(bodies):
+                        done.set()
+        return counted
+
+    main.handle_message = count(main.handle_message)
+    main.reply_busy = count(main.reply_busy, shed_event=True)
+    client = main.app.test_client()
+    start = time.perf_counter()
+    for body, signature in bodies:
+        client.post("/callback", data=body, headers={"X-Line-Signature": signature})
+    if not done.wait(timeout):
+        print(f"⚠️ {timeout}秒で終わらなかったイベント: {len(bodies) - finished[0]}件", file=sys.stderr)
+    threads = threading.active_count()
+    # 送信箱に溜まった返信を送り切るまでを時間に含める
+    main.shutdown()
+    elapsed = time.perf_counter() - start
+    return elapsed, threads, shed[0]
+
+
+def run_async(bodies, timeout):
+    import asgi
+
+    shed = [0]
+    reply_busy = asgi.reply_busy
+
+    async def counted_busy(event):
+        shed[0] += 1
+        await reply_busy(event)
+
+    asgi.reply_busy = counted_busy
+
+    async def go():
+        await asgi.startup()
+        start = time.perf_counter()
+        for body, signature in bodies:
+            asgi.dispatch(body, signature)
+        await asgi.drain(timeout=timeout)
+        if asgi._tasks:
+            print(f"⚠️ {timeout}秒で終わらなかったイベント: {len(asgi._tasks)}件", file=sys.stderr)
+        await asgi.outbox.drain()
+        elapsed = time.perf_counter() - start
+        threads = threading.active_count()
+        await asgi.shutdown()
+        return elapsed, threads, shed[0]
+
+    return asyncio.run(go())
+
+
+def run_mode(mode, args):
+    bodies = make_webhooks(args.events)
+    if mode == "threaded":
+        elapsed, threads, shed = run_threaded(bodies, args.timeout)
+    else:
+        elapsed, threads, shed = run_async(bodies, args.timeout)
+    print(json.dumps({
+        "mode": mode,
+        "events": args.events,
+        "seconds": round(elapsed, 3),
+        "events_per_sec": round(args.events / elapsed, 1),
+        "shed": shed,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "threads": threads,
+    }))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--events", type=int, default=1000)
+    ap.add_argument("--latency", type=float, default=0.5)
+    ap.add_argument("--workers", type=int, default=64, help="スレッド版のワーカー数")
+    ap.add_argument("--port", type=int, default=9100)
+    ap.add_argument("--timeout", type=float, default=300, help="全イベントの処理を待つ最大秒数")
+    ap.add_argument("--run", choices=["threaded", "async"], help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        sys.path.insert(0, ROOT)
+        run_mode(args.run, args)
+        return
+
+    stub_url = f"http://127.0.0.1:{args.port}"
+    env = dict(
+        os.environ,
+        LINE_CHANNEL_SECRET=SECRET,
+        LINE_CHANNEL_ACCESS_TOKEN="bench-token",
+        OPENAI_API_KEY="bench-key",
+        OPENAI_BASE_URL=f"{stub_url}/v1",
+        LINE_API_ENDPOINT=stub_url,
+        WORKER_CONCURRENCY=str(args.workers),
+        LINE_SENDER_CONCURRENCY=str(args.workers),
+        WORKER_QUEUE_SIZE=str(args.events * 2),
+        ASYNC_MAX_INFLIGHT=str(args.events * 2),
+        # 全イベントが同じ気分なので、キャッシュは切って毎回GPTを呼ばせる
+        SUGGESTION_CACHE_DB=":memory:",
+        SUGGESTION_CACHE_TTL="0",
+        SESSION_STORE="memory",
+        RECIPE_STORE_DB=":memory:",
+        OPENAI_RPM="1000000000",
+        OPENAI_TPM="1000000000",
+    )
+    stub = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "bench", "stub_server.py"),
+         "--port", str(args.port), "--latency", str(args.latency)],
+    )
+    try:
+        for _ in range(50):
+            try:
+                urllib.request.urlopen(f"{stub_url}/stats")
+                break
+            except OSError:
+                time.sleep(0.1)
+        for mode in ("threaded", "async"):
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run", mode,
+                 "--events", str(args.events), "--timeout", str(args.timeout)],
+                env=env, cwd=ROOT, check=True,
+            )
+    finally:
+        stub.terminate()
+        stub.wait()
+
+
+if __name__ == "__main__":
+    main()
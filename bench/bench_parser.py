@@ -0,0 +1,56 @@
+# 提案パーサーの確認とマイクロベンチマーク。
+# python bench/bench_parser.py
+# fixtures/suggestion_outputs.json のモデル出力をそれぞれ小さなチャンクに分けて流し込み、
+# 読み取れたタイトル・サマリーが期待どおりかを確かめたうえで、
+# 行分割パーサー(parse_recipes)との速度と「何文字目で5件そろったか」を比べる。
+
+import json
+import os
+import sys
+import timeit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.recipes import parse_recipes  # noqa: E402
+from utils.suggestion_parser import SuggestionStreamParser  # noqa: E402
+
+CHUNK = 4  # OpenAI のストリームは数文字ずつ届く
+
+
+def stream_parse(text):
+    parser = SuggestionStreamParser()
+    ready_at = None
+    for i in range(0, len(text), CHUNK):
+        parser.feed(text[i:i + CHUNK])
+        if ready_at is None and parser.ready():
+            ready_at = min(i + CHUNK, len(text))
+    return parser.finish(), ready_at
+
+
+def main():
+    with open(os.path.join(ROOT, "bench", "fixtures", "suggestion_outputs.json"), encoding="utf-8") as f:
+        corpus = json.load(f)
+
+    failed = 0
+    print(f"{'fixture':<24}{'ok':<4}{'5件目まで':>10}{'stream µs':>12}{'legacy µs':>12}")
+    for case in corpus:
+        text = case["text"]
+        (suggestions, summary), ready_at = stream_parse(text)
+        ok = [s["title"] for s in suggestions] == case["titles"] and summary == case["summary"]
+        failed += not ok
+
+        n = 2000
+        stream_us = timeit.timeit(lambda: stream_parse(text), number=n) / n * 1e6
+        legacy_us = timeit.timeit(lambda: parse_recipes(text), number=n) / n * 1e6
+        ready = f"{ready_at}/{len(text)}" if ready_at else f"-/{len(text)}"
+        print(f"{case['name']:<24}{'✓' if ok else '✗':<4}{ready:>10}{stream_us:>12.1f}{legacy_us:>12.1f}")
+        if not ok:
+            print(f"    expected {case['titles']} / {case['summary']!r}")
+            print(f"    got      {[s['title'] for s in suggestions]} / {summary!r}")
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
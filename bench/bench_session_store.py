@@ -0,0 +1,103 @@
+# セッションストアのメモリ・スループットを、大量のユーザーで測る。
+# python bench/bench_session_store.py --users 1000000
+# バックエンドごとに別プロセスで動かし、増えた最大メモリ(ru_maxrss)を比べる。
+
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 提案5件分のセッション（実際の値と同じくらいの大きさ）
+SESSION = [
+    {"title": "冷やし中華", "reason": "さっぱりしていて暑い日にぴったり。"},
+    {"title": "梅しそ冷しゃぶ", "reason": "梅の酸味で食欲がわく。"},
+    {"title": "トマトの冷製パスタ", "reason": "火を使う時間が短い。"},
+    {"title": "鶏ささみの棒棒鶏", "reason": "あっさりしてたんぱく質もとれる。"},
+    {"title": "冷や汁", "reason": "宮崎の郷土料理で体が冷える。"},
+]
+
+
+def run_backend(backend, users, path):
+    sys.path.insert(0, ROOT)
+    from utils.session_store import MemorySessionStore, SqliteSessionStore
+
+    if backend == "memory":
+        store = MemorySessionStore(ttl=3600, sweep_interval=0)
+    else:
+        store = SqliteSessionStore(path, ttl=3600, sweep_interval=0)
+    keys = [f"U{i:032x}" for i in range(users)]
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    start = time.perf_counter()
+    if backend == "sqlite":
+        # まとめて入れるときは1トランザクションにする（初期投入だけ）
+        store._conn().execute("BEGIN")
+    for key in keys:
+        store.set(key, SESSION)
+    if backend == "sqlite":
+        store._conn().execute("COMMIT")
+    set_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys:
+        store.get(key)
+    get_seconds = time.perf_counter() - start
+
+    sample = keys[:min(users, 100000)]
+    start = time.perf_counter()
+    for key in sample:
+        store.set(key, SESSION)
+    single_set_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in sample:
+        store.update(key, lambda v: v, default=[])
+    update_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for key in keys[:len(keys) // 2]:
+        store.set(key, SESSION, ttl=-1)
+    store.sweep()
+    sweep_seconds = time.perf_counter() - start
+
+    print(json.dumps({
+        "backend": backend,
+        "users": users,
+        "set_per_sec": round(users / set_seconds),
+        "get_per_sec": round(users / get_seconds),
+        "autocommit_set_per_sec": round(len(sample) / single_set_seconds),
+        "update_per_sec": round(len(sample) / update_seconds),
+        "expire_half_and_sweep_seconds": round(sweep_seconds, 2),
+        "rss_growth_mb": round((resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - base_rss) / 1024, 1),
+        "db_mb": round(os.path.getsize(path) / 1024 / 1024, 1) if backend == "sqlite" else None,
+    }))
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--users", type=int, default=1000000)
+    ap.add_argument("--run", choices=["memory", "sqlite"], help=argparse.SUPPRESS)
+    ap.add_argument("--path", help=argparse.SUPPRESS)
+    args = ap.parse_args()
+
+    if args.run:
+        run_backend(args.run, args.users, args.path)
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for backend in ("memory", "sqlite"):
+            subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--run", backend,
+                 "--users", str(args.users), "--path", os.path.join(tmp, "sessions.db")],
+                check=True,
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+# 本物のモデル出力を fixtures/suggestion_outputs.json に取り込む。
+# OPENAI_API_KEY=... python bench/capture_suggestions.py
+# OPENAI_API_KEY=... python bench/capture_suggestions.py --no-json-mode 疲れた   # JSONモードなし（形式が崩れやすい）
+# 本番と同じプロンプト・同じストリーミング設定で問い合わせ、届いたテキストをそのまま保存する。
+# 期待値の titles / summary は、JSONとして読めたものはそこから、読めなかったものは空のまま入れるので、
+# 目で確かめて埋めてからコミットする（空のままのケースはテストで失敗する）。
+
+import argparse
+import datetime
+import json
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from openai import OpenAI  # noqa: E402
+
+from utils.conversation import MODEL  # noqa: E402
+from utils.recipes import generate_recipe_prompt  # noqa: E402
+
+FIXTURES = os.path.join(ROOT, "bench", "fixtures", "suggestion_outputs.json")
+MOODS = ["暑くて食欲がない", "疲れた", "寒い", "がっつり食べたい", "甘いものが食べたい", "二日酔い"]
+
+
+def capture(client, mood, json_mode):
+    request = {
+        "model": MODEL,
+        "messages": [{"role": "user", "content": generate_recipe_prompt(mood)}],
+        "stream": True,
+    }
+    if json_mode:
+        request["response_format"] = {"type": "json_object"}
+    text, model = [], MODEL
+    for chunk in client.chat.completions.create(**request):
+        model = chunk.model or model
+        if chunk.choices and chunk.choices[0].delta.content:
+            text.append(chunk.choices[0].delta.content)
+    return "".join(text), model
+
+
+def expected(text):
+    try:
+        data = json.loads(text)
+        return [item["title"] for item in data["items"]][:5], data.get("summary", "").strip()
+    except (ValueError, KeyError, TypeError):
+        return [], ""
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("moods", nargs="*", default=MOODS)
+    parser.add_argument("--no-json-mode", action="store_true", help="response_format を付けずに問い合わせる")
+    args = parser.parse_args()
+
+    client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
+    with open(FIXTURES, encoding="utf-8") as f:
+        corpus = json.load(f)
+    names = {case["name"] for case in corpus}
+    today = datetime.date.today().isoformat()
+    mode = "text" if args.no_json_mode else "json_object"
+
+    for mood in args.moods:
+        text, model = capture(client, mood, not args.no_json_mode)
+        titles, summary = expected(text)
+        base = f"captured_{mode}_{len(names)}"
+        names.add(base)
+        corpus.append({
+            "name": base,
+            "source": f"captured {model} {mode} {today}",
+            "note": f"気分: {mood}",
+            "text": text,
+            "titles": titles,
+            "summary": summary,
+        })
+        print(f"{base:<28}{'要確認' if not titles else ''} {titles}")
+
+    with open(FIXTURES, "w", encoding="utf-8") as f:
+        json.dump(corpus, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,289 @@
+# オフライン負荷試験。OpenAI と LINE の代用サーバーをこのプロセス内に立て、Bot本体を別プロセスで起動して
+# 署名付きの Webhook を目標RPSで /callback に送り続ける。
+#
+#   python bench/loadtest.py --rps 50 --duration 60 --users 300 --latency 1.5 --openai-429-rate 0.02
+#   python bench/loadtest.py --cmd "{python} -m uvicorn asgi:app --port {port}"
+#
+# ユーザーはまず気分を送り、Flexの提案が届いたら少し考えてから番号(1〜5)を送る。
+# 終わったら、受付(HTTP 200)までの時間・「考え中」返信・提案カード・詳細レシピそれぞれの遅延の分位点、
+# 返ってこなかった返信、期限切れの reply token、LINE API の呼び出し回数、代用サーバーが返した 429/5xx の数を表示する。
+# 変更を入れる前後で同じ条件で回して比べる。
+
+import argparse
+import asyncio
+import heapq
+import json
+import os
+import random
+import shlex
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+
+import aiohttp
+from aiohttp import web
+
+from stub_server import add_arguments, create_app, state_from_args
+from webhook import signed_body, text_event
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRET = "loadtest-secret"
+MOODS = ["暑い", "疲れた", "さっぱりしたい", "がっつり食べたい", "寒い", "甘いものが食べたい", "スイーツ", "飲み物がほしい", "二日酔い", "元気を出したい"]
+
+
+def percentiles(values):
+    if not values:
+        return {"n": 0}
+    values = sorted(values)
+
+    def pick(q):
+        return round(values[min(len(values) - 1, int(q * len(values)))], 3)
+
+    return {"n": len(values), "p50": pick(0.5), "p90": pick(0.9), "p99": pick(0.99), "max": round(values[-1], 3)}
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.url = args.url
+        self.events = {}       # reply token -> 送ったイベントの記録
+        self.pending_mood = {}  # user_id -> カード待ちの気分イベントの reply token（古い順）
+        self.waiting = {}       # user_id -> まだ何も返ってきていないイベントの reply token（古い順）
+        self.ready = []         # (番号を送る時刻, user_id)
+        self.idle = set(f"U{uuid.uuid4().hex}" for _ in range(args.users))
+        self.ack = []
+        self.statuses = {}
+        self.card_failures = 0
+        self.stub = state_from_args(args, on_reply=self.on_reply, on_push=self.on_push)
+
+    def on_reply(self, token, messages):
+        record = self.events.get(token)
+        if record is None:
+            return
+        self.delivered(record["user"], token, messages)
+
+    def on_push(self, user_id, messages):
+        # push には reply token がないので、そのユーザーのまだ返事のない一番古いイベント宛てとみなす
+        tokens = self.waiting.get(user_id)
+        self.delivered(user_id, tokens[0] if tokens else None, messages)
+
+    def delivered(self, user_id, token, messages):
+        text = " ".join(m.get("text", "") for m in messages)
+        has_card = any(m.get("type") == "flex" for m in messages)
+        kind = (
+            "card" if has_card else
+            "detail" if "作り方" in text else
+            "thinking" if "考え中" in text else
+            "busy" if "混み合って" in text else
+            "quota" if "今日の提案" in text else
+            "failed" if "失敗" in text else
+            "other"
+        )
+        # 答えがそろったら「考え中」は取り消されるはず。一緒に届いたら replies_by_kind に別で出す
+        if has_card and "考え中" in text:
+            kind = "thinking+card"
+        tokens = self.waiting.get(user_id, [])
+        if token in tokens:
+            record = self.events[token]
+            record["replied"] = time.perf_counter() - record["sent"]
+            record["reply"] = kind
+            tokens.remove(token)
+        if kind in ("thinking", "detail", "failed") and not has_card:
+            return
+
+        pending = self.pending_mood.get(user_id)
+        if not pending:
+            return
+        record = self.events[pending.pop(0)]
+        if has_card:
+            record["card"] = time.perf_counter() - record["sent"]
+            think = random.uniform(*self.args.think)
+            heapq.heappush(self.ready, (time.perf_counter() + think, user_id))
+        else:
+            # 断られたか、考え中のあとに失敗のお知らせが来た
+            if record.get("reply") == "thinking":
+                self.card_failures += 1
+                record["card_failed"] = True
+            self.idle.add(user_id)
+
+    def next_message(self):
+        now = time.perf_counter()
+        if self.ready and self.ready[0][0] <= now:
+            _, user_id = heapq.heappop(self.ready)
+            return user_id, str(random.randint(1, 5)), "select"
+        if self.idle:
+            user_id = random.choice(tuple(self.idle))
+            self.idle.discard(user_id)
+        else:
+            # 全員が返事待ちなら、誰かがもう一度送ってくる（連投）
+            user_id = random.choice(tuple(self.pending_mood) or ("U" + uuid.uuid4().hex,))
+        return user_id, random.choice(MOODS), "mood"
+
+    async def send(self, session, user_id, text, kind):
+        token = uuid.uuid4().hex
+        self.stub.issue_token(token)
+        body, signature = signed_body(SECRET, [text_event(user_id, text, token, token)])
+        record = self.events[token] = {"kind": kind, "user": user_id, "sent": time.perf_counter()}
+        self.waiting.setdefault(user_id, []).append(token)
+        if kind == "mood":
+            self.pending_mood.setdefault(user_id, []).append(token)
+        else:
+            self.idle.add(user_id)
+        try:
+            async with session.post(
+                f"{self.url}/callback", data=body.encode("utf-8"),
+                headers={"X-Line-Signature": signature, "Content-Type": "application/json"},
+            ) as response:
+                await response.read()
+                status = response.status
+        except aiohttp.ClientError as e:
+            status = type(e).__name__
+        self.ack.append(time.perf_counter() - record["sent"])
+        self.statuses[status] = self.statuses.get(status, 0) + 1
+
+    async def drive(self):
+        args = self.args
+        connector = aiohttp.TCPConnector(limit=args.connections)
+        timeout = aiohttp.ClientTimeout(total=30)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+            tasks = set()
+            start = time.perf_counter()
+            sent = 0
+            while time.perf_counter() - start < args.duration:
+                # 開始からの経過時間で送る件数を決めるので、送信が遅れても目標RPSに追いつく
+                due = int((time.perf_counter() - start) * args.rps) + 1
+                while sent < due:
+                    task = asyncio.create_task(self.send(session, *self.next_message()))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                    sent += 1
+                await asyncio.sleep(min(0.01, 1 / args.rps))
+            self.elapsed = time.perf_counter() - start
+            if tasks:
+                await asyncio.wait(tasks)
+        # 返信・プッシュが出そろうのを待つ
+        deadline = time.perf_counter() + args.drain
+        while time.perf_counter() < deadline and not self.settled():
+            await asyncio.sleep(0.2)
+
+    def settled(self):
+        for record in self.events.values():
+            if "replied" not in record:
+                return False
+            if record["kind"] == "mood" and record.get("reply") == "thinking" \
+                    and "card" not in record and not record.get("card_failed"):
+                return False
+        return True
+
+    def report(self):
+        records = list(self.events.values())
+        moods = [r for r in records if r["kind"] == "mood"]
+        selects = [r for r in records if r["kind"] == "select"]
+        replies = {}
+        for r in records:
+            replies[r.get("reply", "none")] = replies.get(r.get("reply", "none"), 0) + 1
+        thinking = [r for r in moods if r.get("reply") == "thinking"]
+        return {
+            "webhooks_sent": len(records),
+            "target_rps": self.args.rps,
+            "achieved_rps": round(len(records) / self.elapsed, 1),
+            "http_status": {str(k): v for k, v in self.statuses.items()},
+            "ack_seconds": percentiles(self.ack),
+            "thinking_reply_seconds": percentiles([r["replied"] for r in thinking]),
+            "card_seconds": percentiles([r["card"] for r in moods if "card" in r]),
+            "detail_seconds": percentiles([r["replied"] for r in selects if r.get("reply") == "detail"]),
+            "replies_by_kind": replies,
+            "dropped_replies": sum(1 for r in records if "replied" not in r),
+            "missing_cards": sum(1 for r in thinking if "card" not in r and not r.get("card_failed")),
+            "error_cards": self.card_failures,
+            "expired_reply_tokens": self.stub.counts["reply_expired"],
+            "reused_reply_tokens": self.stub.counts["reply_reused"],
+            "line_api_calls": self.stub.counts["reply"] + self.stub.counts["push"],
+            "stub": self.stub.counts,
+        }
+
+
+async def wait_ready(url, timeout=30):
+    deadline = time.perf_counter() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.perf_counter() < deadline:
+            try:
+                async with session.get(f"{url}/metrics") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} が起動しませんでした")
+
+
+async def main_async(args):
+    test = LoadTest(args)
+    runner = web.AppRunner(create_app(test.stub), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", args.stub_port).start()
+
+    app_process = None
+    tmp = tempfile.TemporaryDirectory()
+    if not args.url:
+        test.url = f"http://127.0.0.1:{args.port}"
+        stub_url = f"http://127.0.0.1:{args.stub_port}"
+        env = dict(os.environ)
+        env.update(
+            PORT=str(args.port),
+            LINE_CHANNEL_SECRET=SECRET,
+            LINE_CHANNEL_ACCESS_TOKEN="loadtest-token",
+            OPENAI_API_KEY="loadtest-key",
+            OPENAI_BASE_URL=f"{stub_url}/v1",
+            LINE_API_ENDPOINT=stub_url,
+            SUGGESTION_CACHE_DB=os.path.join(tmp.name, "suggestion_cache.db"),
+            RECIPE_STORE_DB=os.path.join(tmp.name, "recipe_store.db"),
+            SESSION_DB=os.path.join(tmp.name, "sessions.db"),
+        )
+        # 利用回数の制限はこの試験の対象外。試したいときは環境変数で上書きする
+        for key, value in (("USER_DAILY_LIMIT", "1000000"), ("OPENAI_RPM", "1000000"), ("OPENAI_TPM", "1000000000")):
+            env[key] = os.environ.get(key, value)
+        if args.cold:
+            env["SUGGESTION_CACHE_TTL"] = "0"
+        cmd = args.cmd.format(python=sys.executable, port=args.port)
+        app_process = subprocess.Popen(shlex.split(cmd), cwd=ROOT, env=env)
+    try:
+        await wait_ready(test.url)
+        await test.drive()
+    finally:
+        if app_process:
+            app_process.terminate()
+            app_process.wait()
+        await runner.cleanup()
+        tmp.cleanup()
+
+    result = test.report()
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rps", type=float, default=20, help="1秒あたりに送る Webhook の数")
+    ap.add_argument("--duration", type=float, default=30, help="送り続ける秒数")
+    ap.add_argument("--drain", type=float, default=60, help="送り終えてから返信を待つ最大秒数")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--think", type=float, nargs=2, default=(1.0, 5.0), help="提案を見てから番号を送るまでの秒数(最小 最大)")
+    ap.add_argument("--connections", type=int, default=200, help="/callback への同時接続数")
+    ap.add_argument("--cold", action="store_true", help="提案キャッシュを切る")
+    ap.add_argument("--cmd", default="{python} -m gunicorn -c gunicorn.conf.py main:app",
+                    help="Bot本体の起動コマンド。{python} と {port} が置き換わる")
+    ap.add_argument("--port", type=int, default=8000)
+    ap.add_argument("--url", help="起動済みのBotに送る場合のURL（代用サーバーへの向き先は自分で設定する）")
+    ap.add_argument("--stub-port", type=int, default=9100)
+    ap.add_argument("--output", help="結果のJSONを書き出すファイル")
+    add_arguments(ap)
+    asyncio.run(main_async(ap.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
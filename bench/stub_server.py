@@ -0,0 +1,212 @@
+# OpenAI と LINE Messaging API のローカル代用サーバー（ベンチマーク・負荷試験用）。
+# python bench/stub_server.py --port 9100 --latency 0.5 --openai-429-rate 0.05
+# OPENAI_BASE_URL=http://127.0.0.1:9100/v1 と LINE_API_ENDPOINT=http://127.0.0.1:9100 で向き先を変える。
+# 応答の待ち時間・エラー率・429の割合を指定でき、reply token の期限切れ・使い回しも本物と同じく 400 で返す。
+# push は本物と同じく X-Line-Retry-Key を見て、受け付け済みのキーには 409 を返す。
+# --line-lost-rate で、push を受け付けたのに 500 を返す（応答が失われた）場合も作れる。
+
+import argparse
+import asyncio
+import json
+import random
+import time
+from aiohttp import web
+
+SUGGESTION = json.dumps({
+    "summary": "暑さで疲れた体に優しい、さっぱり系のレシピです。",
+    "items": [
+        {"title": "冷やし中華", "reason": "さっぱりしていて暑い日にぴったり。"},
+        {"title": "梅しそ冷しゃぶ", "reason": "梅の酸味で食欲がわく。"},
+        {"title": "トマトの冷製パスタ", "reason": "火を使う時間が短い。"},
+        {"title": "鶏ささみの棒棒鶏", "reason": "あっさりしてたんぱく質もとれる。"},
+        {"title": "冷や汁", "reason": "宮崎の郷土料理で体が冷える。"},
+    ],
+}, ensure_ascii=False)
+
+USAGE = {"prompt_tokens": 250, "completion_tokens": 180, "total_tokens": 430}
+
+DETAIL = "2〜3人前\n\n【材料】\n- 中華麺 2玉\n\n【作り方】\n1. 麺をゆでる\n\n豆メモ：冷やし中華は仙台発祥と言われています。"
+
+SENT = {"sentMessages": [{"id": "1", "quoteToken": "q"}]}
+
+
+class StubState:
+    # 負荷試験から同じプロセスで使うときは、on_reply / on_push で届いたメッセージを受け取れる。
+    # issue_token() で登録した reply token だけ期限・使い回しを確かめる（未登録のものはそのまま通す）
+    def __init__(self, latency=0.5, line_latency=0.05, jitter=0.0,
+                 openai_error_rate=0.0, openai_429_rate=0.0,
+                 line_error_rate=0.0, line_429_rate=0.0, line_lost_rate=0.0, reply_ttl=60.0,
+                 on_reply=None, on_push=None):
+        self.latency = latency
+        self.line_latency = line_latency
+        self.jitter = jitter
+        self.openai_error_rate = openai_error_rate
+        self.openai_429_rate = openai_429_rate
+        self.line_error_rate = line_error_rate
+        self.line_429_rate = line_429_rate
+        self.line_lost_rate = line_lost_rate
+        self.reply_ttl = reply_ttl
+        self.on_reply = on_reply
+        self.on_push = on_push
+        self.issued = {}
+        self.used = set()
+        self.retry_keys = set()
+        self.counts = {
+            "chat": 0, "chat_429": 0, "chat_5xx": 0,
+            "reply": 0, "reply_expired": 0, "reply_reused": 0, "reply_429": 0, "reply_5xx": 0,
+            "push": 0, "push_messages": 0, "push_429": 0, "push_5xx": 0,
+            "push_lost": 0, "push_409": 0,
+        }
+
+    def issue_token(self, token):
+        self.issued[token] = time.time()
+
+    def wait(self, base):
+        return asyncio.sleep(max(0.0, random.gauss(base, base * self.jitter)) if self.jitter else base)
+
+    def inject(self, name, error_rate, rate_429):
+        r = random.random()
+        if r < rate_429:
+            self.counts[f"{name}_429"] += 1
+            return web.json_response({"message": "Rate limit exceeded"}, status=429)
+        if r < rate_429 + error_rate:
+            self.counts[f"{name}_5xx"] += 1
+            return web.json_response({"message": "Internal server error"}, status=500)
+        return None
+
+
+def create_app(state=None):
+    state = state or StubState()
+
+    async def chat_completions(request):
+        payload = await request.json()
+        state.counts["chat"] += 1
+        error = state.inject("chat", state.openai_error_rate, state.openai_429_rate)
+        if error is not None:
+            await state.wait(state.latency / 10)
+            return error
+        prompt = payload["messages"][-1]["content"]
+        content = DETAIL if "full recipe" in prompt else SUGGESTION
+        if payload.get("stream"):
+            return await stream_completion(request, payload, content)
+        await state.wait(state.latency)
+        return web.json_response({
+            "id": f"chatcmpl-{state.counts['chat']}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-3.5-turbo"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop",
+            }],
+            "usage": USAGE,
+        })
+
+    async def stream_completion(request, payload, content, chunks=30):
+        # 最初のトークンまでに latency の半分、残りを均等に流す
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        await state.wait(state.latency / 2)
+        step = max(1, len(content) // chunks)
+        base = {
+            "id": f"chatcmpl-{state.counts['chat']}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": payload.get("model", "gpt-3.5-turbo"),
+        }
+        for i in range(0, len(content), step):
+            data = dict(base, choices=[{
+                "index": 0, "delta": {"content": content[i:i + step]}, "finish_reason": None,
+            }])
+            await response.write(f"data: {json.dumps(data, ensure_ascii=False)}\n\n".encode("utf-8"))
+            await asyncio.sleep(state.latency / 2 / chunks)
+        data = dict(base, choices=[{"index": 0, "delta": {}, "finish_reason": "stop"}])
+        await response.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+        if payload.get("stream_options", {}).get("include_usage"):
+            data = dict(base, choices=[], usage=USAGE)
+            await response.write(f"data: {json.dumps(data)}\n\n".encode("utf-8"))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
+
+    async def reply(request):
+        payload = await request.json()
+        await state.wait(state.line_latency)
+        error = state.inject("reply", state.line_error_rate, state.line_429_rate)
+        if error is not None:
+            return error
+        token = payload["replyToken"]
+        issued = state.issued.get(token)
+        if issued is not None:
+            if token in state.used:
+                state.counts["reply_reused"] += 1
+                return web.json_response({"message": "Invalid reply token"}, status=400)
+            if time.time() - issued > state.reply_ttl:
+                state.counts["reply_expired"] += 1
+                return web.json_response({"message": "Invalid reply token"}, status=400)
+            state.used.add(token)
+        state.counts["reply"] += 1
+        if state.on_reply:
+            state.on_reply(token, payload["messages"])
+        return web.json_response(SENT)
+
+    async def push(request):
+        payload = await request.json()
+        await state.wait(state.line_latency)
+        error = state.inject("push", state.line_error_rate, state.line_429_rate)
+        if error is not None:
+            return error
+        retry_key = request.headers.get("X-Line-Retry-Key")
+        if retry_key in state.retry_keys:
+            state.counts["push_409"] += 1
+            return web.json_response({"message": "The retry key is already accepted"}, status=409)
+        if retry_key:
+            state.retry_keys.add(retry_key)
+        state.counts["push"] += 1
+        state.counts["push_messages"] += len(payload["messages"])
+        if state.on_push:
+            state.on_push(payload["to"], payload["messages"])
+        if random.random() < state.line_lost_rate:
+            state.counts["push_lost"] += 1
+            return web.json_response({"message": "Internal server error"}, status=500)
+        return web.json_response(SENT)
+
+    async def stats(request):
+        return web.json_response(state.counts)
+
+    app = web.Application()
+    app.router.add_post("/v1/chat/completions", chat_completions)
+    app.router.add_post("/v2/bot/message/reply", reply)
+    app.router.add_post("/v2/bot/message/push", push)
+    app.router.add_get("/stats", stats)
+    return app
+
+
+def add_arguments(ap):
+    ap.add_argument("--latency", type=float, default=0.5, help="GPT応答の待ち時間(秒)")
+    ap.add_argument("--line-latency", type=float, default=0.05, help="LINE API の待ち時間(秒)")
+    ap.add_argument("--jitter", type=float, default=0.0, help="待ち時間のばらつき（標準偏差 / 平均）")
+    ap.add_argument("--openai-error-rate", type=float, default=0.0)
+    ap.add_argument("--openai-429-rate", type=float, default=0.0)
+    ap.add_argument("--line-error-rate", type=float, default=0.0)
+    ap.add_argument("--line-429-rate", type=float, default=0.0)
+    ap.add_argument("--line-lost-rate", type=float, default=0.0, help="受け付けたのに 500 を返す push の割合")
+    ap.add_argument("--reply-ttl", type=float, default=60.0, help="reply token の有効期限(秒)")
+
+
+def state_from_args(args, **hooks):
+    return StubState(
+        latency=args.latency, line_latency=args.line_latency, jitter=args.jitter,
+        openai_error_rate=args.openai_error_rate, openai_429_rate=args.openai_429_rate,
+        line_error_rate=args.line_error_rate, line_429_rate=args.line_429_rate,
+        line_lost_rate=args.line_lost_rate, reply_ttl=args.reply_ttl, **hooks,
+    )
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=9100)
+    add_arguments(ap)
+    args = ap.parse_args()
+    web.run_app(create_app(state_from_args(args)), host="127.0.0.1", port=args.port, print=None, access_log=None)
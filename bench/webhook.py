@@ -0,0 +1,28 @@
+# LINE から届くのと同じ形の Webhook ボディと X-Line-Signature を作る。
+
+import base64
+import hashlib
+import hmac
+import json
+import time
+
+
+def text_event(user_id, text, reply_token, event_id):
+    return {
+        "type": "message",
+        "mode": "active",
+        "timestamp": int(time.time() * 1000),
+        "source": {"type": "user", "userId": user_id},
+        "webhookEventId": event_id,
+        "deliveryContext": {"isRedelivery": False},
+        "replyToken": reply_token,
+        "message": {"id": event_id, "type": "text", "text": text, "quoteToken": "q"},
+    }
+
+
+def signed_body(secret, events, destination="bench"):
+    body = json.dumps({"destination": destination, "events": events}, ensure_ascii=False)
+    signature = base64.b64encode(
+        hmac.new(secret.encode("utf-8"), body.encode("utf-8"), hashlib.sha256).digest()
+    ).decode("utf-8")
+    return body, signature
@@ -0,0 +1,33 @@
+# gunicorn -c gunicorn.conf.py main:app
+import os
+
+bind = "0.0.0.0:" + os.environ.get("PORT", "8000")
+workers = int(os.environ.get("WEB_CONCURRENCY", "2"))
+# 終了時にキューの残りを処理しきる猶予
+graceful_timeout = int(os.environ.get("GRACEFUL_TIMEOUT", "60"))
+_metrics_tmp = None
+
+
+def on_starting(server):
+    # ワーカーごとのメトリクスを1か所に書き出して、/metrics で合計を返す
+    global _metrics_tmp
+    import glob
+    import tempfile
+    path = os.environ.get("METRICS_DIR")
+    if path:
+        os.makedirs(path, exist_ok=True)
+        for old in glob.glob(os.path.join(path, "*.json")):
+            os.remove(old)
+    else:
+        _metrics_tmp = os.environ["METRICS_DIR"] = tempfile.mkdtemp(prefix="recipe-bot-metrics-")
+
+
+def on_exit(server):
+    if _metrics_tmp:
+        import shutil
+        shutil.rmtree(_metrics_tmp, ignore_errors=True)
+
+
+def worker_exit(server, worker):
+    import main
+    main.shutdown(timeout=graceful_timeout - 5)
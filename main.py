@@ -1,10 +1,9 @@
-# version: v1.8.0
+# version: v1.12.0
 # description: LINEレシピBot本体コード。GPT-3.5を使って気分に合う5つの料理を提案し、選ばれた1つの詳細レシピを返す。ボタンは料理名のみ表示、Flexで縦並び。サマリーも表示可。
 
 import os
 import time
-import threading
-import re  # ファイル上部に追加
+import atexit
 from flask import Flask, request, abort
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
@@ -13,219 +12,161 @@ from linebot.models import (
 )
 from dotenv import load_dotenv
 from openai import OpenAI
+from utils.dispatcher import Dispatcher
+from utils.delivery import Outbox
+from utils.recipes import build_flex_bubble
+from utils.suggestion_cache import SuggestionCache
+from utils.recipe_store import RecipeStore
+from utils.session_store import open_store
+from utils.conversation import Conversation, BUSY_TEXT
+from utils import metrics
 
 load_dotenv()
 app = Flask(__name__)
 
-line_bot_api = LineBotApi(os.environ["LINE_CHANNEL_ACCESS_TOKEN"])
+line_bot_api = LineBotApi(
+    os.environ["LINE_CHANNEL_ACCESS_TOKEN"],
+    endpoint=os.environ.get("LINE_API_ENDPOINT", "https://api.line.me")
+)
 handler = WebhookHandler(os.environ["LINE_CHANNEL_SECRET"])
-openai_client = OpenAI(api_key=os.environ["OPENAI_API_KEY"])
-
-user_sessions = {}
-
-def generate_recipe_prompt(user_msg):
-    if "スイーツ" in user_msg or "デザート" in user_msg:
-        category = "Japanese desserts"
-    elif "ドリンク" in user_msg or "飲み物" in user_msg:
-        category = "Japanese drinks"
-    else:
-        category = "Japanese meals"
-
-    prompt = f"""
-The user says: "{user_msg}"
-Please suggest 5 {category} based on this mood.
-Each suggestion must include:
-- title
-- a brief reason why it fits the mood
-- one overall summary sentence (1 short line) about the general theme of the suggestions, such as "These recipes are refreshing and help cool down on a hot day."
-
-Respond only in Japanese.
-Avoid generic items like coffee, udon, or somen unless user asked.
-Avoid drinks or desserts unless requested.
-Use common ingredients and simple ideas, but make at least one feel new or clever.
-"""
-    return prompt
-
-def generate_detail_prompt(title):
-    return f"""
-You are a Japanese cooking expert. Please write a full recipe for the following item.
-
-【Dish】{title}
-
-Language rules:
-- If the title is in Japanese, respond entirely in Japanese.
-- If the title is in English, respond entirely in English.
-
-Recipe should include:
-
-1. How many servings it makes (e.g., 2〜3人前)
-2. List of ingredients using simple units:
-   - Use friendly measurements like "a little", "1 handful", "1 piece"
-   - Avoid using grams (g), milliliters (ml), or complex cooking terms
-3. Step-by-step instructions (max 7 steps):
-   - Add brief explanations **only where it's especially helpful or interesting**
-     (e.g., "Start with skin side down to make it crispy")
-   - If the recipe allows shortcuts (e.g., pre-made tempura for tendon), include that as an option
-4. At the end, include a fun or useful fact about the dish
-   - Make it light and friendly
-   - Start with one of the following headers (choose randomly): 
-     「料理の小ネタ」, 「知ってると話したくなる話」, 「この料理、実は…」, 「ちょこっと豆知識」, 「豆メモ」
-
-This rule applies to:
-- Meals
-- Desserts (スイーツ / sweets)
-- Drinks (ドリンク / beverages)
-
-Be concise, clear, and beginner-friendly.
-"""
+# ワーカーが応答待ちで止まりっぱなしにならないよう、SDK標準(10分)より短く切る
+openai_client = OpenAI(
+    api_key=os.environ["OPENAI_API_KEY"],
+    timeout=float(os.environ.get("OPENAI_TIMEOUT", "30")),
+)
+
+# user_id -> 提案中のレシピ一覧。SESSION_STORE=sqlite ならワーカー間で共有される
+user_sessions = open_store("sessions", ttl=int(os.environ.get("SESSION_TTL", "86400")))
+
+# 同じような気分には保存済みの提案を返して、GPTの待ち時間と料金を節約する
+suggestion_cache = SuggestionCache(
+    path=os.environ.get("SUGGESTION_CACHE_DB", "suggestion_cache.db"),
+    ttl=int(os.environ.get("SUGGESTION_CACHE_TTL", str(6 * 3600))),
+    max_entries=int(os.environ.get("SUGGESTION_CACHE_SIZE", "5000")),
+)
+# 詳細レシピは料理名ごとに保存して使い回す（reply_token が切れる前に返すため）
+recipe_store = RecipeStore(
+    path=os.environ.get("RECIPE_STORE_DB", "recipe_store.db"),
+    prewarm_top=int(os.environ.get("RECIPE_PREWARM_TOP", "20")),
+    prewarm_min_selections=int(os.environ.get("RECIPE_PREWARM_MIN_SELECTIONS", "3")),
+)
+
+# Webhookごとにスレッドを立てず、固定数のワーカーとキューで処理する
+dispatcher = Dispatcher(
+    workers=int(os.environ.get("WORKER_CONCURRENCY", "8")),
+    queue_size=int(os.environ.get("WORKER_QUEUE_SIZE", "256")),
+)
+
+metrics.register_stats("recipe_bot_suggestion_cache", suggestion_cache.stats)
+metrics.register_stats("recipe_bot_recipe_store", recipe_store.stats)
 
 def build_flex_message(user_msg, recipes):
-    seen_titles = set()
-    buttons = []
-
-    for i, item in enumerate(recipes):
-        raw_title = item.get("title", "レシピ").strip()
-        # 先頭の番号・句読点（例: 1. 明太子パスタ）を除去
-        title = re.sub(r"^[0-9]+[.:：\\s]*", "", raw_title)[:20]
-
-        if not title or title in seen_titles:
-            continue
-        seen_titles.add(title)
-
-        buttons.append({
-            "type": "button",
-            "action": {
-                "type": "message",
-                "label": f"{i+1}. {title}",
-                "text": f"{i+1}"
-            },
-            "style": "primary",
-            "margin": "sm"
-        })
-
-    bubble = {
-        "type": "bubble",
-        "body": {
-            "type": "box",
-            "layout": "vertical",
-            "contents": [
-                {
-                    "type": "text",
-                    "text": f"「{user_msg}」にぴったりなレシピ、選んでね👇",
-                    "weight": "bold",
-                    "size": "md",
-                    "wrap": True
-                }
-            ]
-        },
-        "footer": {
-            "type": "box",
-            "layout": "vertical",
-            "spacing": "sm",
-            "contents": buttons
-        }
-    }
-
-    return FlexSendMessage(alt_text="レシピの提案です", contents=bubble)
+    return FlexSendMessage(alt_text="レシピの提案です", contents=build_flex_bubble(user_msg, recipes))
+
+def reply_message(reply_token, messages):
+    with metrics.stage("line_reply"):
+        line_bot_api.reply_message(reply_token, messages)
+
+def push_message(to, messages, retry_key=None):
+    with metrics.stage("line_push"):
+        line_bot_api.push_message(to, messages, retry_key=retry_key)
+
+# 返信はすべて送信箱を通す。reply token が使えるうちは reply、切れたら push で、まとめて送る
+outbox = Outbox(
+    reply=reply_message,
+    push=push_message,
+    status_of=lambda e: getattr(e, "status_code", None),
+    workers=int(os.environ.get("LINE_SENDER_CONCURRENCY", "16")),
+)
+
+def shutdown(timeout=30):
+    # キューの残りを処理しきってから、溜まった返信を送り切る
+    deadline = time.monotonic() + timeout
+    dispatcher.shutdown(timeout=timeout)
+    outbox.shutdown(timeout=max(5, deadline - time.monotonic()))
+
+atexit.register(shutdown)
+
+conversation = Conversation(
+    outbox, user_sessions, suggestion_cache, recipe_store,
+    text_message=lambda text: TextSendMessage(text=text),
+    flex_message=build_flex_message,
+    # 「考え中」はこの秒数だけ待たせてから送る。その間に提案がそろえば、1回の reply にまとめて送る
+    thinking_delay=float(os.environ.get("THINKING_DELAY", "1.0")),
+)
+
+@app.route("/metrics")
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
 
 @app.route("/callback", methods=["POST"])
 def callback():
-    signature = request.headers["X-Line-Signature"]
-    body = request.get_data(as_text=True)
-    threading.Thread(target=handle_event_async, args=(body, signature)).start()
+    with metrics.stage("webhook"):
+        signature = request.headers["X-Line-Signature"]
+        body = request.get_data(as_text=True)
+        try:
+            with metrics.stage("verify_signature"):
+                events = handler.parser.parse(body, signature)
+        except InvalidSignatureError:
+            print("❌ Invalid signature")
+            metrics.ERRORS.inc(where="signature")
+            abort(400)
+
+        for event in events:
+            user_id = getattr(event.source, "user_id", None)
+            if not dispatcher.submit(user_id, handle_event, event, time.perf_counter()):
+                metrics.ERRORS.inc(where="queue_full")
+                reply_busy(event)
     return "OK"
 
-def handle_event_async(body, signature):
+def handle_event(event, received):
+    with metrics.trace(event=event.type):
+        metrics.observe("queue_wait", time.perf_counter() - received)
+        if isinstance(event, MessageEvent) and isinstance(event.message, TextMessage):
+            handle_message(event)
+
+def reply_busy(event):
+    # キューが満杯のときはGPTを呼ばずにすぐ断る
+    reply_token = getattr(event, "reply_token", None)
+    if not reply_token:
+        return
     try:
-        handler.handle(body, signature)
-    except InvalidSignatureError:
-        print("❌ Invalid signature")
+        reply_message(reply_token, TextSendMessage(text=BUSY_TEXT))
+    except Exception as e:
+        print(f"❌ LINE送信エラー: {e}")
+        metrics.ERRORS.inc(where="line")
+
+def generate_detail(title):
+    with conversation.detail_call(title) as call:
+        with metrics.stage("openai_detail"):
+            call.reply = openai_client.chat.completions.create(**call.request)
+    return call.content()
+
+recipe_store.start_prewarm(generate_detail)
 
-@handler.add(MessageEvent, message=TextMessage)
 def handle_message(event):
     user_id = event.source.user_id
     user_msg = event.message.text.strip()
-
-    if user_id in user_sessions:
-        if user_msg.isdigit():
-            index = int(user_msg) - 1
-            if 0 <= index < len(user_sessions[user_id]):
-                selected = user_sessions[user_id][index]
-                detail_prompt = generate_detail_prompt(selected["title"])
-                try:
-                    print("🔁 GPTに詳細レシピを問い合わせ中...")
-                    reply = openai_client.chat.completions.create(
-                        model="gpt-3.5-turbo",
-                        messages=[{"role": "user", "content": detail_prompt}]
-                    )
-                    detailed_recipe = reply.choices[0].message.content
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text=f"{selected['title']} の作り方です：\n\n{detailed_recipe}")
-                    )
-                except Exception as e:
-                    print(f"❌ GPTエラー発生: {e}")
-                    line_bot_api.reply_message(
-                        event.reply_token,
-                        TextSendMessage(text="レシピ取得に失敗しました。後でもう一度お試しください。")
-                    )
-                del user_sessions[user_id]
-                return
-
-    line_bot_api.reply_message(
-        event.reply_token,
-        TextSendMessage(text="メッセージ受け取りました。考え中です…🤔")
-    )
-
-    try:
-        start = time.time()
-        prompt = generate_recipe_prompt(user_msg)
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[{"role": "user", "content": prompt}]
-        )
-        content = response.choices[0].message.content.strip()
-        elapsed = time.time() - start
-
-        lines = content.split("\n")
-        recipes = []
-        for line in lines:
-            if line.strip() == "":
-                continue
-            if line[0].isdigit():
-                parts = line.split("：", 1) if "：" in line else line.split(":", 1)
-                if len(parts) > 1:
-                    title = parts[1].strip().split("。", 1)[0].split(".", 1)[0]
-                else:
-                    title = parts[0].strip()
-                recipes.append({"title": title, "reason": ""})
-            elif recipes:
-                recipes[-1]["reason"] += line.strip() + " "
-
-        # Remove trailing whitespace from reason
-        for r in recipes:
-            r["reason"] = r["reason"].strip()
-
-        user_sessions[user_id] = recipes[:5]
-        flex_msg = build_flex_message(user_msg, user_sessions[user_id])
-
-        summary_line = ""
-        if recipes and recipes[-1]['reason'].startswith("全体の傾向："):
-            summary_line = recipes.pop()['reason'].replace("全体の傾向：", "")
-
-        if summary_line:
-            line_bot_api.push_message(
-                user_id,
-                [TextSendMessage(text=summary_line), flex_msg]
-            )
+    # reply token の期限は LINE がイベントを受けた時刻から数える
+    outbox.register(user_id, event.reply_token, event.timestamp / 1000)
+
+    kind, title = conversation.begin(user_id, user_msg)
+    if kind == "detail":
+        try:
+            recipe = recipe_store.get_or_create(title, generate_detail)
+        except Exception as e:
+            conversation.detail_failed(user_id, e)
         else:
-            line_bot_api.push_message(
-                user_id,
-                [flex_msg]
-            )
-    except Exception as e:
-        print(f"❌ GPTエラー発生: {e}")
-        line_bot_api.push_message(
-            user_id,
-            TextSendMessage(text="ちょっと調子が悪いみたいです💦 また後で試してみてください🙏")
-        )
+            conversation.send_detail(user_id, title, recipe)
+    elif kind == "suggest":
+        turn = conversation.suggestion_turn(user_id, user_msg)
+        try:
+            stream = openai_client.chat.completions.create(**turn.request())
+            for chunk in stream:
+                if turn.feed(chunk):
+                    turn.push_early()
+            turn.finish()
+        except Exception as e:
+            turn.fail(e)
+        finally:
+            turn.settle()
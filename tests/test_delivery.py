@@ -0,0 +1,181 @@
+# python -m pytest -q tests
+# 送信箱(utils/delivery.py)の reply token の期限、まとめ送り、取り消し、やり直しを、LINE APIの代わりの関数で確かめる。
+
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import delivery  # noqa: E402
+
+
+class LineError(Exception):
+    def __init__(self, status):
+        super().__init__(f"status {status}")
+        self.status_code = status
+
+
+class FakeLine:
+    # reply / push の呼び出しを記録する。fail に積んだステータスを先頭から順に例外として返す
+    def __init__(self, fail=()):
+        self.calls = []
+        self.fail = list(fail)
+        self.lock = threading.Lock()
+
+    def _call(self, record):
+        with self.lock:
+            self.calls.append(record)
+            status = self.fail.pop(0) if self.fail else None
+        if status is not None:
+            raise LineError(status)
+
+    def reply(self, token, messages):
+        self._call(("reply", token, list(messages)))
+
+    def push(self, user_id, messages, retry_key=None):
+        self._call(("push", user_id, list(messages), retry_key))
+
+
+def outbox(line, **kwargs):
+    kwargs.setdefault("backoff", 0.01)
+    return delivery.Outbox(line.reply, line.push, lambda e: getattr(e, "status_code", None), **kwargs)
+
+
+def wait_sent(box, timeout=5):
+    deadline = time.time() + timeout
+    while box.pending() and time.time() < deadline:
+        time.sleep(0.01)
+    assert not box.pending()
+
+
+def test_batches_up_to_five_and_pushes_the_rest():
+    line = FakeLine()
+    box = outbox(line)
+    box.register("u", "token")
+    box.send("u", [f"m{i}" for i in range(7)], delay=0.05)
+    wait_sent(box)
+    assert line.calls[0] == ("reply", "token", ["m0", "m1", "m2", "m3", "m4"])
+    # reply token は1回しか使えないので、残りは push
+    assert line.calls[1][:3] == ("push", "u", ["m5", "m6"])
+    assert len(line.calls) == 2
+
+
+def test_messages_within_delay_share_one_reply():
+    line = FakeLine()
+    box = outbox(line)
+    box.send("u", ["thinking"], "token", delay=0.1)
+    box.send("u", ["card"])
+    wait_sent(box)
+    assert line.calls == [("reply", "token", ["thinking", "card"])]
+
+
+def test_expired_token_uses_push():
+    line = FakeLine()
+    box = outbox(line)
+    box.send("u", ["late"], "token", received=time.time() - delivery.REPLY_TOKEN_TTL)
+    wait_sent(box)
+    assert [call[0] for call in line.calls] == ["push"]
+
+
+def test_discard_drops_only_the_keyed_message():
+    line = FakeLine()
+    box = outbox(line)
+    box.register("u", "token")
+    box.send("u", ["thinking"], delay=0.2, key="thinking")
+    box.discard("u", "thinking")
+    box.send("u", ["card"])
+    wait_sent(box)
+    assert line.calls == [("reply", "token", ["card"])]
+
+
+def test_retries_5xx_and_429_with_backoff():
+    line = FakeLine(fail=[500, 429])
+    box = outbox(line)
+    box.send("u", ["hi"], "token")
+    wait_sent(box)
+    assert [call[0] for call in line.calls] == ["reply", "reply", "reply"]
+
+
+def test_rejected_token_falls_back_to_push():
+    line = FakeLine(fail=[400])
+    box = outbox(line)
+    box.send("u", ["hi"], "token")
+    wait_sent(box)
+    assert [call[0] for call in line.calls] == ["reply", "push"]
+
+
+def test_switches_to_push_when_backoff_would_pass_deadline():
+    line = FakeLine(fail=[503])
+    box = outbox(line, backoff=1.0)
+    # 期限まで 0.1 秒しかないので、バックオフのあとは reply ではなく push で送る
+    received = time.time() - delivery.REPLY_TOKEN_TTL + delivery.REPLY_MARGIN + 0.1
+    box.send("u", ["hi"], "token", received=received)
+    wait_sent(box)
+    assert [call[0] for call in line.calls] == ["reply", "push"]
+
+
+def test_gives_up_on_other_client_errors():
+    line = FakeLine(fail=[403])
+    box = outbox(line)
+    box.send("u", ["hi"])
+    wait_sent(box)
+    assert len(line.calls) == 1
+
+
+def test_push_retries_reuse_the_retry_key():
+    # 1回目は届いたのに応答が 500、2回目は同じキーなので 409。二重に送ったことにはしない
+    line = FakeLine(fail=[500, 409])
+    box = outbox(line)
+    box.send("u", ["hi"])
+    wait_sent(box)
+    box.send("u", ["again"])
+    wait_sent(box)
+    first, retry, second = line.calls
+    assert first[3] == retry[3]
+    assert second[2] == ["again"] and second[3] != first[3]
+
+
+def test_async_outbox_batches_and_discards():
+    line = FakeLine()
+
+    async def reply(token, messages):
+        line.reply(token, messages)
+
+    async def push(user_id, messages, retry_key=None):
+        line.push(user_id, messages, retry_key)
+
+    async def run():
+        box = delivery.AsyncOutbox(reply, push, lambda e: getattr(e, "status_code", None), backoff=0.01)
+        box.register("u", "token")
+        box.send("u", ["thinking"], delay=0.2, key="thinking")
+        # 別スレッドから送っても、イベントループ上で同じ箱に入る
+        await asyncio.to_thread(box.send, "u", ["card"], None, None, 0.05)
+        box.discard("u", "thinking")
+        await asyncio.sleep(0.3)
+        await box.drain(timeout=5)
+
+    asyncio.run(run())
+    assert line.calls == [("reply", "token", ["card"])]
+
+
+@pytest.mark.parametrize("status", [500, 429])
+def test_async_outbox_retries(status):
+    line = FakeLine(fail=[status])
+
+    async def push(user_id, messages, retry_key=None):
+        line.push(user_id, messages, retry_key)
+
+    async def run():
+        box = delivery.AsyncOutbox(None, push, lambda e: getattr(e, "status_code", None), backoff=0.01)
+        box.send("u", ["hi"])
+        await asyncio.sleep(0)
+        await box.drain(timeout=5)
+
+    asyncio.run(run())
+    assert len(line.calls) == 2 and line.calls[0][3] == line.calls[1][3]
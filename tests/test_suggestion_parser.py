@@ -0,0 +1,44 @@
+# python -m pytest -q tests
+# bench/fixtures/suggestion_outputs.json のモデル出力を数文字ずつ流し込み、
+# 読み取れたタイトル・サマリーと、カードを先に送るタイミング(ready)が正しいかを確かめる。
+
+import json
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils.suggestion_parser import SuggestionStreamParser  # noqa: E402
+
+with open(os.path.join(ROOT, "bench", "fixtures", "suggestion_outputs.json"), encoding="utf-8") as f:
+    CASES = json.load(f)
+
+
+@pytest.mark.parametrize("chunk", [1, 4, 64])
+@pytest.mark.parametrize("case", CASES, ids=[case["name"] for case in CASES])
+def test_fixture(case, chunk):
+    assert case["titles"], "期待値の titles が空です。出力を確かめて埋めてください"
+    parser = SuggestionStreamParser()
+    early = None
+    for i in range(0, len(case["text"]), chunk):
+        parser.feed(case["text"][i:i + chunk])
+        if early is None and parser.ready():
+            early = parser.suggestions()
+
+    suggestions, summary = parser.finish()
+    assert [s["title"] for s in suggestions] == case["titles"]
+    assert summary == case["summary"]
+    if early is not None:
+        # 先に送ったカードのタイトルは、最後まで読んだ結果と同じでなければならない
+        assert [s["title"] for s in early] == case["titles"]
+
+
+def test_empty_title_does_not_count():
+    parser = SuggestionStreamParser()
+    items = [{"title": t, "reason": "r"} for t in ("a", "b", "", "c", "d")]
+    parser.feed(json.dumps({"summary": "s", "items": items})[:-2])
+    assert not parser.ready()
+    assert [s["title"] for s in parser.suggestions()] == ["a", "b", "c", "d"]
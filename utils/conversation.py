@@ -0,0 +1,247 @@
+import asyncio
+import time
+
+from utils.recipes import generate_recipe_prompt, generate_detail_prompt
+from utils.suggestion_cache import mood_key
+from utils.suggestion_parser import SuggestionStreamParser
+from utils.rate_limiter import RateLimited
+from utils.usage_tracker import consume_usage, refund_usage, reserve_openai, settle_openai
+from utils import metrics
+
+# main.py（スレッド版）と asgi.py（asyncio版）で共通の会話の流れ。
+# 何をどの順で送り、何を保存するかはここで決め、GPTへの問い合わせ（同期 / 非同期）だけを各エントリポイントに残す。
+#
+#   kind, title = conversation.begin(user_id, user_msg)
+#   "detail"  -> 詳細レシピを作って send_detail() / detail_failed()
+#   "suggest" -> turn = conversation.suggestion_turn(...) に GPT のストリームを feed() し（True なら push_early()）、finish()
+#   None      -> begin() の中で返信まで済んでいる
+#
+# SQLiteを読み書きするのは begin / push_early / finish / fail / settle / send_detail / detail_failed と
+# DetailCall の出入りだけ。asyncio 版はこれらを別スレッドで呼び、イベントループを止めない。
+
+MODEL = "gpt-3.5-turbo"
+
+THINKING_TEXT = "メッセージ受け取りました。考え中です…🤔"
+QUOTA_TEXT = "今日の提案はここまでです🙏 また明日話しかけてください！"
+BUSY_TEXT = "ただいま混み合っています💦 少し時間をおいてもう一度送ってください🙏"
+SORRY_TEXT = "ちょっと調子が悪いみたいです💦 また後で試してみてください🙏"
+DETAIL_FAILED_TEXT = "レシピ取得に失敗しました。後でもう一度お試しください。"
+
+
+class Conversation:
+    def __init__(self, outbox, sessions, cache, recipes, text_message, flex_message, thinking_delay=1.0):
+        # text_message(text) / flex_message(user_msg, suggestions) は、使っている LINE SDK のメッセージを作る
+        self.outbox = outbox
+        self.sessions = sessions
+        self.cache = cache
+        self.recipes = recipes
+        self.text_message = text_message
+        self.flex_message = flex_message
+        self.thinking_delay = thinking_delay
+
+    def send_text(self, user_id, text, delay=0.0, key=None):
+        self.outbox.send(user_id, [self.text_message(text)], delay=delay, key=key)
+
+    def begin(self, user_id, user_msg):
+        session = self.sessions.get(user_id)
+        if session is not None and user_msg.isdigit():
+            index = int(user_msg) - 1
+            if 0 <= index < len(session):
+                title = session[index]["title"]
+                self.recipes.record_selection(title)
+                return "detail", title
+
+        # 1日の回数を超えていたら、GPTを呼ぶ前に断る
+        if not consume_usage(user_id):
+            self.send_text(user_id, QUOTA_TEXT)
+            return None, None
+
+        key = mood_key(user_msg)
+        try:
+            cached = self.cache.get(key) if key else None
+        except Exception as e:
+            print(f"❌ キャッシュエラー発生: {e}")
+            metrics.ERRORS.inc(where="suggest")
+            self.send_text(user_id, SORRY_TEXT)
+            return None, None
+        if cached:
+            # キャッシュにあれば「考え中」を挟まず、提案をそのまま返す
+            self.push_suggestions(user_id, user_msg, *cached)
+            return None, None
+        return "suggest", None
+
+    def push_suggestions(self, user_id, user_msg, suggestions, summary_line):
+        self.sessions.set(user_id, suggestions)
+        self.recipes.record_offers([s["title"] for s in suggestions])
+        with metrics.stage("flex_build"):
+            flex_msg = self.flex_message(user_msg, suggestions)
+        if summary_line:
+            self.outbox.send(user_id, [self.text_message(summary_line), flex_msg])
+        else:
+            self.outbox.send(user_id, [flex_msg])
+
+    def detail_call(self, title):
+        return DetailCall(title)
+
+    def send_detail(self, user_id, title, recipe):
+        self.send_text(user_id, f"{title} の作り方です：\n\n{recipe}")
+        self.sessions.delete(user_id)
+
+    def detail_failed(self, user_id, error):
+        if isinstance(error, RateLimited):
+            # 混雑で断っただけなので、セッションは残して同じ番号をもう一度選べるようにする
+            print(f"⏳ OpenAIの予算切れ: {error}")
+            metrics.ERRORS.inc(where="rate_limited")
+            self.send_text(user_id, BUSY_TEXT)
+            return
+        print(f"❌ GPTエラー発生: {error}")
+        metrics.ERRORS.inc(where="detail")
+        self.send_text(user_id, DETAIL_FAILED_TEXT)
+        self.sessions.delete(user_id)
+
+    def suggestion_turn(self, user_id, user_msg):
+        return SuggestionTurn(self, user_id, user_msg)
+
+
+class DetailCall:
+    # 詳細レシピの問い合わせ1回分。with の中で reply に応答を入れると、抜けるときに必ず予算を精算する
+    #   with conversation.detail_call(title) as call:
+    #       call.reply = openai_client.chat.completions.create(**call.request)
+    #   return call.content()
+    # asyncio 版は async with で使う。予算の確保と精算（SQLiteの書き込み）は別スレッドで行う
+    def __init__(self, title):
+        self.title = title
+        self.request = None
+        self.reply = None
+
+    def __enter__(self):
+        reserve_openai()
+        print("🔁 GPTに詳細レシピを問い合わせ中...")
+        with metrics.stage("prompt_build"):
+            prompt = generate_detail_prompt(self.title)
+        self.request = {"model": MODEL, "messages": [{"role": "user", "content": prompt}]}
+        return self
+
+    def __exit__(self, *exc):
+        if self.reply is None:
+            # 応答が来なかったので、予約を全部戻す
+            settle_openai(0)
+            return
+        metrics.record_usage("detail", self.reply.usage)
+        settle_openai(self.reply.usage.total_tokens if self.reply.usage else None)
+
+    async def __aenter__(self):
+        return await asyncio.to_thread(self.__enter__)
+
+    async def __aexit__(self, *exc):
+        await asyncio.to_thread(self.__exit__, *exc)
+
+    def content(self):
+        return self.reply.choices[0].message.content
+
+
+class SuggestionTurn:
+    # 気分から5つの提案を作る1回分。GPTのストリームを1チャンクずつ feed() に渡す
+    def __init__(self, conversation, user_id, user_msg):
+        self.conversation = conversation
+        self.user_id = user_id
+        self.user_msg = user_msg
+        self.cache_key = mood_key(user_msg)
+        self.parser = SuggestionStreamParser()
+        self.tokens = None
+        self.reserved = False
+        self.parse_seconds = 0.0
+        self.pushed = False
+        self.pushed_summary = ""
+        self.start = None
+        # 答えが thinking_delay 秒以内にそろえば、「考え中」は取り消して送らない
+        conversation.send_text(user_id, THINKING_TEXT, delay=conversation.thinking_delay, key="thinking")
+
+    def _answer(self):
+        self.conversation.outbox.discard(self.user_id, "thinking")
+
+    def request(self):
+        reserve_openai()
+        self.reserved = True
+        self.start = time.time()
+        with metrics.stage("prompt_build"):
+            prompt = generate_recipe_prompt(self.user_msg)
+        return {
+            "model": MODEL,
+            "messages": [{"role": "user", "content": prompt}],
+            "response_format": {"type": "json_object"},
+            "stream": True,
+            "stream_options": {"include_usage": True},
+        }
+
+    def feed(self, chunk):
+        # 5件のタイトルがそろったら True。理由の続きを待たずに push_early() でFlexを送る
+        if chunk.usage:
+            self.tokens = chunk.usage.total_tokens
+            metrics.record_usage("suggest", chunk.usage)
+        if chunk.choices and chunk.choices[0].delta.content:
+            t = time.perf_counter()
+            self.parser.feed(chunk.choices[0].delta.content)
+            self.parse_seconds += time.perf_counter() - t
+        return not self.pushed and self.parser.ready()
+
+    def push_early(self):
+        metrics.observe("openai_first_card", time.time() - self.start)
+        self._answer()
+        self.conversation.push_suggestions(
+            self.user_id, self.user_msg, self.parser.suggestions(), self.parser.summary
+        )
+        self.pushed = True
+        self.pushed_summary = self.parser.summary
+
+    def finish(self):
+        elapsed = time.time() - self.start
+        metrics.observe("openai_suggest", elapsed)
+
+        with metrics.stage("parse"):
+            suggestions, summary_line = self.parser.finish()
+        metrics.observe("parse_stream", self.parse_seconds)
+        if not suggestions:
+            # 断られた・どちらのパーサーでも読めなかった。ボタンのないカードは送らず、失敗として謝る
+            print(f"❌ 提案を読み取れませんでした: {''.join(self.parser.text)[:200]!r}")
+            metrics.ERRORS.inc(where="suggest")
+            if not self.pushed:
+                self._answer()
+                self.conversation.send_text(self.user_id, SORRY_TEXT)
+            return
+        if not self.pushed:
+            self._answer()
+            self.conversation.push_suggestions(self.user_id, self.user_msg, suggestions, summary_line)
+            self.pushed = True
+        else:
+            # 先に送ったカードは理由が途中までなので、セッションを最後まで読んだ内容で置き直す
+            self.conversation.sessions.set(self.user_id, suggestions)
+            # summary が items の後ろに来たときは、カードのあとに別に送る
+            if summary_line and not self.pushed_summary:
+                self.conversation.send_text(self.user_id, summary_line)
+        if self.cache_key:
+            self.conversation.cache.put(self.cache_key, suggestions, summary_line, self.tokens or 0, elapsed)
+
+    def settle(self):
+        # 成功しても失敗しても呼ぶ。何も届かなかったときは予約を全部戻す
+        if not self.reserved:
+            return
+        self.reserved = False
+        if self.tokens is None and not self.parser.text:
+            settle_openai(0)
+        else:
+            settle_openai(self.tokens)
+
+    def fail(self, error):
+        if isinstance(error, RateLimited):
+            print(f"⏳ OpenAIの予算切れ: {error}")
+            metrics.ERRORS.inc(where="rate_limited")
+            refund_usage(self.user_id)
+            self._answer()
+            self.conversation.send_text(self.user_id, BUSY_TEXT)
+            return
+        print(f"❌ GPTエラー発生: {error}")
+        metrics.ERRORS.inc(where="suggest")
+        if not self.pushed:
+            self._answer()
+            self.conversation.send_text(self.user_id, SORRY_TEXT)
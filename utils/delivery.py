@@ -0,0 +1,322 @@
+import asyncio
+import contextvars
+import heapq
+import os
+import random
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import metrics
+
+# LINEへの送信をまとめて受け持つ送信箱。
+# - reply token ごとに期限（Webhookを受けた時刻 + REPLY_TOKEN_TTL）を覚えておき、
+#   期限内なら無料の reply API で、切れていたら push API で送る。
+# - 同じユーザー宛てに溜まったメッセージは、1回のAPI呼び出しに最大5件までまとめる。
+#   send(..., delay=秒) で送信を少し待たせると、その間に来たメッセージも同じ呼び出しに乗る。
+#   send(..., key=...) で送ったものは、まだ出ていなければ discard(user_id, key) で取り消せる
+#   （答えが先にそろったら「考え中」は送らない、など）。
+# - 429 / 5xx はジッター付きの指数バックオフでやり直す。reply 中に期限が来そうなら push に切り替える。
+#   push はまとめごとに1つの retry key を付けて送るので、届いていたのに応答が失われても二重には届かない
+#   （LINE は同じ retry key に 409 を返す。これは送れたものとして扱う）。
+# - 送信は send() を呼んだときのトレース(metrics.trace)の中で行い、送り終わるまでトレースの書き出しを待たせる。
+# 同じユーザー宛ての送信は同時に1つだけなので、順番は入れ替わらない。
+
+REPLY_TOKEN_TTL = float(os.environ.get("REPLY_TOKEN_TTL", "60"))
+# 送信にかかる時間を見込んで、期限のこれだけ前からは reply を使わない
+REPLY_MARGIN = float(os.environ.get("REPLY_TOKEN_MARGIN", "5"))
+MAX_MESSAGES = 5
+
+DELIVERIES = metrics.Counter(
+    "recipe_bot_line_deliveries_total", "LINE API calls made by the outbox", labels=("api", "result")
+)
+
+
+class _Mailbox:
+    __slots__ = ("messages", "reply_token", "deadline", "due", "sending")
+
+    def __init__(self):
+        self.messages = []
+        self.reply_token = None
+        self.deadline = 0.0
+        self.due = None
+        self.sending = False
+
+
+class _OutboxState:
+    # スレッド版・asyncio版で共通の、宛先ごとの溜め込みと reply token の管理
+    def __init__(self, reply, push, status_of, max_attempts=5, backoff=0.5):
+        self._reply = reply
+        self._push = push
+        self._status_of = status_of
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self._boxes = {}
+
+    def _enqueue(self, user_id, messages, reply_token, received, delay, key=None):
+        # messages の1件ごとに (key, message, 送った時のコンテキスト, トレースの待たせを解く関数) を積む
+        now = time.time()
+        box = self._boxes.get(user_id)
+        if box is None:
+            box = self._boxes[user_id] = _Mailbox()
+        if reply_token:
+            deadline = (received or now) + REPLY_TOKEN_TTL - REPLY_MARGIN
+            # 新しいトークンの方が長く使える
+            if deadline > now and deadline > box.deadline:
+                box.reply_token = reply_token
+                box.deadline = deadline
+        if not messages:
+            return None
+        context = contextvars.copy_context()
+        box.messages.extend((key, message, context, metrics.hold()) for message in messages)
+        due = now + delay
+        if box.due is None or due < box.due:
+            box.due = due
+            return due
+        return None
+
+    def _take(self, user_id):
+        # 次に送るメッセージ（最大5件）と、使える reply token を取り出す
+        box = self._boxes.get(user_id)
+        if box is None or box.sending or not box.messages:
+            return None
+        box.sending = True
+        box.due = None
+        entries, box.messages = box.messages[:MAX_MESSAGES], box.messages[MAX_MESSAGES:]
+        batch = [entry[1] for entry in entries]
+        releases = [entry[3] for entry in entries]
+        token = None
+        if box.reply_token and time.time() < box.deadline:
+            token, box.reply_token = box.reply_token, None
+        # 最初のメッセージを送ったときのコンテキストで送る。同じコンテキストに2つのスレッドから入れないので写しを使う
+        context = entries[0][2].copy()
+        return context, (batch, token, box.deadline, str(uuid.uuid4()), releases)
+
+    def _finish(self, user_id):
+        # 送り終えたあと、まだ溜まっていればすぐ次を送る。何もなければ片付ける
+        box = self._boxes[user_id]
+        box.sending = False
+        if box.messages:
+            box.due = time.time()
+            return box.due
+        if not box.reply_token or time.time() >= box.deadline:
+            del self._boxes[user_id]
+        return None
+
+    def _discard(self, user_id, key):
+        box = self._boxes.get(user_id)
+        if box is not None:
+            for entry in box.messages:
+                if entry[0] == key:
+                    entry[3]()
+            box.messages = [entry for entry in box.messages if entry[0] != key]
+
+    def _next_step(self, error, attempt, token, deadline):
+        # 失敗したときに (待つ秒数, 次に使う reply token) を返す。諦めるなら None
+        status = self._status_of(error)
+        if token and status == 400:
+            # 期限切れ・使用済みのトークン。すぐ push で送り直す
+            return 0.0, None
+        if status is not None and status != 429 and status < 500:
+            return None
+        if attempt + 1 >= self.max_attempts:
+            return None
+        wait = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+        if token and time.time() + wait >= deadline:
+            token = None
+        return wait, token
+
+    def _accepted(self, error, token):
+        # 同じ retry key の push がもう受け付けられていた
+        return not token and self._status_of(error) == 409
+
+    def _record(self, token, result):
+        DELIVERIES.inc(api="reply" if token else "push", result=result)
+
+    def _sweep(self):
+        now = time.time()
+        for user_id, box in list(self._boxes.items()):
+            if not box.sending and not box.messages and now >= box.deadline:
+                self._boxes.pop(user_id, None)
+
+
+class Outbox(_OutboxState):
+    def __init__(self, reply, push, status_of, workers=4, **kwargs):
+        super().__init__(reply, push, status_of, **kwargs)
+        self._lock = threading.Condition()
+        self._heap = []
+        self._closed = False
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="line-sender")
+        threading.Thread(target=self._schedule_loop, name="line-outbox", daemon=True).start()
+
+    def register(self, user_id, reply_token, received=None):
+        # 返信はまだないが、あとで使えるように reply token だけ覚えておく
+        self.send(user_id, [], reply_token, received)
+
+    def send(self, user_id, messages, reply_token=None, received=None, delay=0.0, key=None):
+        with self._lock:
+            due = self._enqueue(user_id, list(messages), reply_token, received, delay, key)
+            if due is not None:
+                heapq.heappush(self._heap, (due, user_id))
+                self._lock.notify()
+
+    def discard(self, user_id, key):
+        with self._lock:
+            self._discard(user_id, key)
+
+    def _schedule_loop(self):
+        last_sweep = time.time()
+        while True:
+            with self._lock:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._lock.wait(self._heap[0][0] - time.time() if self._heap else 1.0)
+                    if time.time() - last_sweep > 60:
+                        self._sweep()
+                        last_sweep = time.time()
+                _, user_id = heapq.heappop(self._heap)
+                taken = self._take(user_id)
+            if taken is not None:
+                context, args = taken
+                self._pool.submit(context.run, self._deliver, user_id, *args)
+
+    def _deliver(self, user_id, batch, token, deadline, retry_key, releases):
+        attempt = 0
+        while True:
+            try:
+                if token:
+                    self._reply(token, batch)
+                else:
+                    self._push(user_id, batch, retry_key)
+                self._record(token, "ok")
+                break
+            except Exception as e:
+                if self._accepted(e, token):
+                    self._record(token, "duplicate")
+                    break
+                self._record(token, "error")
+                step = self._next_step(e, attempt, token, deadline)
+                if step is None:
+                    print(f"❌ LINE送信エラー: {e}")
+                    metrics.ERRORS.inc(where="line")
+                    break
+                wait, token = step
+                attempt += 1
+                time.sleep(wait)
+        for release in releases:
+            release()
+        with self._lock:
+            due = self._finish(user_id)
+            if due is not None:
+                heapq.heappush(self._heap, (due, user_id))
+                self._lock.notify()
+
+    def pending(self):
+        with self._lock:
+            return sum(len(box.messages) + box.sending for box in self._boxes.values())
+
+    def shutdown(self, timeout=30):
+        # 溜まっているメッセージを送り切ってから止める
+        deadline = time.time() + timeout
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for box in self._boxes.values():
+                box.due = None
+            self._heap = [(time.time(), user_id) for user_id, box in self._boxes.items() if box.messages]
+            heapq.heapify(self._heap)
+            self._lock.notify()
+        while self.pending() and time.time() < deadline:
+            time.sleep(0.05)
+        self._pool.shutdown(wait=False)
+
+
+class AsyncOutbox(_OutboxState):
+    # asyncio 版。reply / push はコルーチン関数を渡す。同時送信数は workers まで。
+    # イベントループの中で作る。send() は asyncio.to_thread などの別スレッドから呼んでもよい
+    def __init__(self, reply, push, status_of, workers=50, **kwargs):
+        super().__init__(reply, push, status_of, **kwargs)
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._senders = asyncio.Semaphore(workers)
+        self._timers = {}
+        self._tasks = set()
+        self._last_sweep = time.time()
+
+    def register(self, user_id, reply_token, received=None):
+        self.send(user_id, [], reply_token, received)
+
+    def send(self, user_id, messages, reply_token=None, received=None, delay=0.0, key=None):
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self.send, user_id, messages, reply_token, received, delay, key)
+            return
+        due = self._enqueue(user_id, list(messages), reply_token, received, delay, key)
+        if due is not None:
+            self._schedule(user_id, due)
+        if time.time() - self._last_sweep > 60:
+            self._sweep()
+            self._last_sweep = time.time()
+
+    def discard(self, user_id, key):
+        if threading.get_ident() != self._loop_thread:
+            self._loop.call_soon_threadsafe(self._discard, user_id, key)
+            return
+        self._discard(user_id, key)
+
+    def _schedule(self, user_id, due):
+        timer = self._timers.pop(user_id, None)
+        if timer is not None:
+            timer.cancel()
+        loop = asyncio.get_running_loop()
+        self._timers[user_id] = loop.call_later(max(0.0, due - time.time()), self._start, user_id)
+
+    def _start(self, user_id):
+        self._timers.pop(user_id, None)
+        taken = self._take(user_id)
+        if taken is None:
+            return
+        context, args = taken
+        # タスクは作った時点のコンテキストを引き継ぐ
+        task = context.run(asyncio.create_task, self._deliver(user_id, *args))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _deliver(self, user_id, batch, token, deadline, retry_key, releases):
+        attempt = 0
+        async with self._senders:
+            while True:
+                try:
+                    if token:
+                        await self._reply(token, batch)
+                    else:
+                        await self._push(user_id, batch, retry_key)
+                    self._record(token, "ok")
+                    break
+                except Exception as e:
+                    if self._accepted(e, token):
+                        self._record(token, "duplicate")
+                        break
+                    self._record(token, "error")
+                    step = self._next_step(e, attempt, token, deadline)
+                    if step is None:
+                        print(f"❌ LINE送信エラー: {e}")
+                        metrics.ERRORS.inc(where="line")
+                        break
+                    wait, token = step
+                    attempt += 1
+                    await asyncio.sleep(wait)
+        for release in releases:
+            release()
+        due = self._finish(user_id)
+        if due is not None:
+            self._schedule(user_id, due)
+
+    async def drain(self, timeout=30):
+        # 待たせているメッセージもすぐ送り、送り終わるまで待つ
+        for user_id, box in list(self._boxes.items()):
+            if box.messages and not box.sending:
+                self._schedule(user_id, time.time())
+        deadline = time.time() + timeout
+        while (self._timers or self._tasks) and time.time() < deadline:
+            await asyncio.sleep(0.05)
@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import deque
+
+# 固定数のワーカーで、全ユーザー共通の上限付きキューを処理するディスパッチャ。
+# イベントは user_id ごとの待ち行列に積み、空いているワーカーがどれでも取り出して処理する。
+# 同じユーザーのイベントは前のものが終わるまで取り出さないので、「提案依頼 → 番号選択」の順序が入れ替わらない。
+# キューが満杯なら submit() は False を返すので、呼び出し側で「混み合っています」を返す。
+
+
+class Dispatcher:
+    def __init__(self, workers=8, queue_size=256, name="dispatcher"):
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        # key -> まだ処理していないイベント。キーがあるあいだは、そのユーザーを誰かが受け持っている
+        self._pending = {}
+        # 次に取り出してよいキー（受け持ちのワーカーがいないもの）
+        self._ready = deque()
+        self._size = 0
+        self._closed = False
+        self._lock = threading.Condition()
+        self._threads = []
+        for i in range(self.workers):
+            t = threading.Thread(target=self._run, name=f"{name}-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, key, func, *args):
+        with self._lock:
+            if self._closed or self._size >= self.queue_size:
+                return False
+            items = self._pending.get(key)
+            if items is None:
+                items = self._pending[key] = deque()
+                self._ready.append(key)
+                self._lock.notify()
+            items.append((func, args, time.monotonic()))
+            self._size += 1
+        return True
+
+    def pending(self):
+        return self._size
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._ready:
+                    if self._closed:
+                        return
+                    self._lock.wait()
+                key = self._ready.popleft()
+                func, args, _enqueued = self._pending[key].popleft()
+                self._size -= 1
+            try:
+                func(*args)
+            except Exception as e:
+                print(f"❌ ワーカーでエラー発生: {e}")
+            with self._lock:
+                # 同じユーザーの続きがあれば、他のユーザーの後ろに並び直す
+                if self._pending[key]:
+                    self._ready.append(key)
+                    self._lock.notify()
+                else:
+                    del self._pending[key]
+
+    def shutdown(self, timeout=30):
+        # 新規受付を止めて、キューに残っているイベントを処理しきってから終了する。
+        # GPTの応答待ちで止まっているワーカーがいても、timeout 秒で諦める
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._lock.notify_all()
+        for t in self._threads:
+            t.join(max(0, deadline - time.monotonic()))
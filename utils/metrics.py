@@ -0,0 +1,303 @@
+import atexit
+import bisect
+import contextvars
+import glob
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# 処理の段階ごとの所要時間をヒストグラムに貯めて、Prometheus のテキスト形式で出す。
+# with stage("openai"): ... で囲むだけで計測できる。
+# TRACE_SAMPLE_RATE の割合のリクエストは、段階ごとの時間を1行のJSONで TRACE_LOG（未指定なら標準出力）に書く。
+# 値はプロセスごとに持つ。METRICS_DIR を指定すると、各プロセスが METRICS_FLUSH_INTERVAL 秒ごとに
+# そのディレクトリへ自分の値を書き出し、/metrics はどのワーカーが答えても全プロセスの合計を返す
+# （gunicorn.conf.py が起動時に用意する）。register_stats のゲージは合計せず、pid ラベルを付けて並べる。
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []
+_stats = []
+
+
+def _format_labels(names, values, extra=""):
+    pairs = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+    def merge(self, values, rows):
+        for key, value in rows:
+            key = tuple(key)
+            values[key] = values.get(key, 0) + value
+
+    def render(self, values=None):
+        values = self._values if values is None else values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(values.items()):
+            lines.append(f"{self.name}{_format_labels(self.labels, key)} {value}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        # ラベルの組 -> [各バケットの件数..., +Inf の件数, 合計]
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            row[i] += 1
+            row[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return [[list(key), list(row)] for key, row in self._values.items()]
+
+    def merge(self, values, rows):
+        for key, row in rows:
+            key = tuple(key)
+            total = values.get(key)
+            if total is None or len(total) != len(row):
+                values[key] = list(row)
+            else:
+                values[key] = [a + b for a, b in zip(total, row)]
+
+    def render(self, values=None):
+        values = self._values if values is None else values
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, row in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), row):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {row[-1]}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("recipe_bot_stage_seconds", "Time spent in each request stage", labels=("stage",))
+OPENAI_TOKENS = Counter("recipe_bot_openai_tokens_total", "Tokens reported by OpenAI usage", labels=("kind", "type"))
+ERRORS = Counter("recipe_bot_errors_total", "Errors by where they happened", labels=("where",))
+
+
+def register_stats(prefix, func):
+    # suggestion_cache.stats() のような dict を返す関数を、ゲージとして出す
+    _stats.append((prefix, func))
+
+
+_DIR = os.environ.get("METRICS_DIR")
+_FLUSH_INTERVAL = float(os.environ.get("METRICS_FLUSH_INTERVAL", "5"))
+_snapshot_path = None
+_flush_lock = threading.Lock()
+
+
+def _snapshot():
+    stats = {}
+    for prefix, func in _stats:
+        for key, value in func().items():
+            stats[f"{prefix}_{key}"] = value
+    return {
+        "pid": os.getpid(),
+        "metrics": {metric.name: metric.snapshot() for metric in _metrics},
+        "stats": stats,
+    }
+
+
+def flush():
+    # 自分の値をファイルに書き出す。書きかけを読まれないよう、別名で書いてから置き換える
+    if not _DIR:
+        return
+    with _flush_lock:
+        _write_snapshot()
+
+
+def _write_snapshot():
+    global _snapshot_path
+    if _snapshot_path is None or not _snapshot_path.startswith(os.path.join(_DIR, f"{os.getpid()}-")):
+        # 同じ pid が使い回されても前のプロセスの値を上書きしないよう、起動時刻も名前に入れる
+        _snapshot_path = os.path.join(_DIR, f"{os.getpid()}-{int(time.time() * 1000)}.json")
+    tmp = _snapshot_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(_snapshot(), f, ensure_ascii=False)
+    os.replace(tmp, _snapshot_path)
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _flush_loop():
+    while True:
+        time.sleep(_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            print(f"❌ メトリクスの書き出しに失敗: {e}")
+
+
+def _start_flusher():
+    global _snapshot_path
+    _snapshot_path = None
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+if _DIR:
+    os.makedirs(_DIR, exist_ok=True)
+    _start_flusher()
+    atexit.register(flush)
+    # gunicorn の preload などで fork されたときは、子プロセスでも書き出しを続ける
+    os.register_at_fork(after_in_child=_start_flusher)
+
+
+def render():
+    if not _DIR:
+        snapshots = [_snapshot()]
+    else:
+        flush()
+        snapshots = []
+        for path in glob.glob(os.path.join(_DIR, "*.json")):
+            try:
+                with open(path, encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+
+    lines = []
+    for metric in _metrics:
+        # 終了したワーカーの分もカウンターには残す（合計が減らないように）
+        values = {}
+        for snapshot in snapshots:
+            metric.merge(values, snapshot["metrics"].get(metric.name, []))
+        lines.extend(metric.render(values))
+
+    gauges = {}
+    for snapshot in snapshots:
+        if _DIR and not _alive(snapshot["pid"]):
+            continue
+        for name, value in snapshot["stats"].items():
+            gauges.setdefault(name, []).append((snapshot["pid"], value))
+    for name, rows in gauges.items():
+        lines.append(f"# TYPE {name} gauge")
+        for pid, value in sorted(rows):
+            labels = f'{{pid="{pid}"}}' if _DIR else ""
+            lines.append(f"{name}{labels} {value}")
+    return "\n".join(lines) + "\n"
+
+
+_TRACE_RATE = float(os.environ.get("TRACE_SAMPLE_RATE", "0"))
+_TRACE_LOG = os.environ.get("TRACE_LOG")
+_trace_lock = threading.Lock()
+_current = contextvars.ContextVar("recipe_bot_trace", default=None)
+
+
+def observe(name, seconds):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    current = _current.get()
+    if current is not None:
+        stages = current[0]["stages"]
+        stages[name] = round(stages.get(name, 0) + seconds, 6)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start)
+
+
+def record_usage(kind, usage):
+    if usage is None:
+        return
+    OPENAI_TOKENS.inc(usage.prompt_tokens, kind=kind, type="prompt")
+    OPENAI_TOKENS.inc(usage.completion_tokens, kind=kind, type="completion")
+    current = _current.get()
+    if current is not None:
+        current[0].setdefault("tokens", {})[kind] = usage.total_tokens
+
+
+@contextmanager
+def trace(**fields):
+    # 抽選に外れたリクエストは何も記録しない（ヒストグラムには入る）
+    if _TRACE_RATE <= 0 or random.random() >= _TRACE_RATE:
+        yield
+        return
+    record = dict(fields, ts=time.time(), stages={})
+    holds = [1]
+    token = _current.set((record, holds))
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        record["total"] = round(time.perf_counter() - start, 6)
+        _release(record, holds)
+
+
+def hold():
+    # 今のトレースを、返した関数が呼ばれるまで書き出さない。
+    # 別スレッド・別タスクで続く処理（送信箱からのLINE送信など）の stage もトレースに入れるために使う
+    current = _current.get()
+    if current is None:
+        return _noop
+    record, holds = current
+    with _trace_lock:
+        holds[0] += 1
+    return lambda: _release(record, holds)
+
+
+def _noop():
+    pass
+
+
+def _release(record, holds):
+    with _trace_lock:
+        holds[0] -= 1
+        if holds[0]:
+            return
+        line = json.dumps(record, ensure_ascii=False)
+        if _TRACE_LOG:
+            with open(_TRACE_LOG, "a", encoding="utf-8") as f:
+                f.write(line + "\n")
+        else:
+            print(line)
@@ -0,0 +1,49 @@
+import time
+
+# トークンバケット方式のレート制限。状態は session_store に [残りトークン, 最終更新時刻] の2つだけ持つ。
+# 確認と消費は store.update の中で一度に行うので、スレッドやワーカーが同時に来ても数え漏れしない。
+# バケットが満タンに戻るまでの時間をキーの有効期限にしているので、しばらく来ないユーザーは自然に消える
+# （消えたキーは満タン扱い）。
+
+
+class RateLimited(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, store, capacity, per_seconds):
+        # per_seconds 秒で capacity 個まで回復する
+        self.store = store
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.ttl = per_seconds
+
+    def _refill(self, record, now):
+        if record is None:
+            return float(self.capacity)
+        tokens, updated = record
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def consume(self, key, cost=1):
+        now = time.time()
+        allowed = [False]
+
+        def take(record):
+            tokens = self._refill(record, now)
+            if tokens >= cost:
+                tokens -= cost
+                allowed[0] = True
+            return [tokens, now]
+
+        self.store.update(key, take, ttl=self.ttl)
+        return allowed[0]
+
+    def refund(self, key, amount):
+        # 見積もりとの差を戻す。amount が負なら追加で差し引く（マイナスも許す）
+        now = time.time()
+        self.store.update(
+            key, lambda record: [min(self.capacity, self._refill(record, now) + amount), now], ttl=self.ttl
+        )
+
+    def remaining(self, key):
+        return self._refill(self.store.get(key), time.time())
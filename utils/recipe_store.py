@@ -0,0 +1,223 @@
+import asyncio
+import hashlib
+import random
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from concurrent.futures import Future
+
+# 詳細レシピの保存先。料理名を正規化した文字列と言語からキーを作り、SQLiteに保存する。
+# 同じ料理への同時リクエストは、最初の1件のGPT呼び出しの結果を全員で待つ（single-flight）。
+# 何度も選ばれていて、今も提案カードに載っている料理は、バックグラウンドで先に作っておく（プリウォーム）。
+# 保存済みでも期限が近いものは作り直すので、人気の料理が期限切れで遅くなることはない。
+
+_JA_CHARS = re.compile(r"[぀-ヿ㐀-鿿]")
+
+
+def normalize_title(title):
+    title = unicodedata.normalize("NFKC", title).strip().lower()
+    title = re.sub(r"^[0-9]+[.:：\s]*", "", title)
+    return re.sub(r"\s+", " ", title)
+
+
+def detect_language(title):
+    # generate_detail_prompt と同じく、料理名が日本語なら日本語で返ってくる
+    return "ja" if _JA_CHARS.search(title) else "en"
+
+
+def recipe_key(title):
+    lang = detect_language(title)
+    return hashlib.sha256(f"{lang}\0{normalize_title(title)}".encode("utf-8")).hexdigest()
+
+
+class RecipeStore:
+    def __init__(self, path=":memory:", ttl=30 * 86400, prewarm_top=20, prewarm_interval=600,
+                 prewarm_min_selections=3):
+        self.ttl = ttl
+        self.prewarm_top = prewarm_top
+        # これだけ選ばれた料理だけを先に作る。誰も選んでいない料理にGPTの予算を使わない
+        self.prewarm_min_selections = prewarm_min_selections
+        self.prewarm_interval = prewarm_interval
+        # プリウォームは、次の回までに期限が切れそうなものも作り直す
+        self.refresh_before = 2 * prewarm_interval
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self._ainflight = {}
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS recipes (
+                key TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                lang TEXT NOT NULL,
+                recipe TEXT NOT NULL,
+                created REAL NOT NULL
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS selections (
+                key TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last REAL NOT NULL
+            )
+        """)
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS offers (
+                key TEXT PRIMARY KEY,
+                title TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                last REAL NOT NULL
+            )
+        """)
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get(self, title, refresh_before=0):
+        # refresh_before 秒以内に期限が切れるものは、無いものとして扱う
+        with self._lock:
+            row = self._db.execute(
+                "SELECT recipe FROM recipes WHERE key = ? AND created > ?",
+                (recipe_key(title), time.time() - self.ttl + refresh_before),
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, title, recipe):
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO recipes VALUES (?, ?, ?, ?, ?)",
+                (recipe_key(title), title, detect_language(title), recipe, time.time()),
+            )
+
+    def record_selection(self, title):
+        now = time.time()
+        with self._lock:
+            self._db.execute("""
+                INSERT INTO selections VALUES (?, ?, 1, ?)
+                ON CONFLICT(key) DO UPDATE SET count = count + 1, last = excluded.last
+            """, (recipe_key(title), title, now))
+
+    def record_offers(self, titles):
+        # 提案カードに載せた料理。選ばれる前に作っておく候補になる
+        now = time.time()
+        with self._lock:
+            self._db.executemany("""
+                INSERT INTO offers VALUES (?, ?, 1, ?)
+                ON CONFLICT(key) DO UPDATE SET count = count + 1, last = excluded.last
+            """, [(recipe_key(title), title, now) for title in titles])
+
+    def get_or_create(self, title, generate, timeout=60, refresh_before=0):
+        recipe = self.get(title, refresh_before)
+        if recipe is not None:
+            self.hits += 1
+            return recipe
+
+        key = recipe_key(title)
+        with self._lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            self.coalesced += 1
+            return future.result(timeout)
+
+        try:
+            # get() のあと、前のリーダーが保存して抜けるまでの間に来た場合は、もう保存されている
+            recipe = self.get(title, refresh_before)
+            if recipe is not None:
+                self.hits += 1
+                future.set_result(recipe)
+                return recipe
+            self.misses += 1
+            recipe = generate(title)
+            self.put(title, recipe)
+            future.set_result(recipe)
+            return recipe
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+
+    async def aget_or_create(self, title, agenerate, refresh_before=0):
+        # asyncio 版。同じイベントループ内の同時リクエストをまとめる。
+        # SQLiteの読み書きは他のワーカーのロックを待つことがあるので、別スレッドで行う
+        recipe = await asyncio.to_thread(self.get, title, refresh_before)
+        if recipe is not None:
+            self.hits += 1
+            return recipe
+
+        key = recipe_key(title)
+        while key in self._ainflight:
+            future = self._ainflight[key]
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(future)
+            except asyncio.CancelledError:
+                # 先に作っていたタスクが止められたときは、自分で作り直す
+                if not future.cancelled():
+                    raise
+
+        future = self._ainflight[key] = asyncio.get_running_loop().create_future()
+        try:
+            # 最初の get() を待つ間に、前のリーダーが保存して抜けていることがある
+            recipe = await asyncio.to_thread(self.get, title, refresh_before)
+            if recipe is not None:
+                self.hits += 1
+                future.set_result(recipe)
+                return recipe
+            self.misses += 1
+            recipe = await agenerate(title)
+            await asyncio.to_thread(self.put, title, recipe)
+            future.set_result(recipe)
+            return recipe
+        except asyncio.CancelledError:
+            # CancelledError は Exception ではないので、ここで待っている人を起こす
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 待っている人がいなくても「例外が取り出されなかった」警告を出さない
+            future.exception()
+            raise
+        finally:
+            del self._ainflight[key]
+
+    def titles_to_prewarm(self):
+        # prewarm_min_selections 回以上選ばれ、最近もカードに載っている料理のうち、
+        # まだ保存されていないか、次のプリウォームまでに期限が切れるもの。選ばれた回数の多い順
+        now = time.time()
+        fresh_after = now - self.ttl + self.refresh_before
+        with self._lock:
+            self._db.execute("DELETE FROM offers WHERE last < ?", (now - self.ttl,))
+            rows = self._db.execute("""
+                SELECT s.title FROM selections s
+                JOIN offers o ON o.key = s.key
+                LEFT JOIN recipes r ON r.key = s.key AND r.created > ?
+                WHERE r.key IS NULL AND s.count >= ?
+                ORDER BY s.count DESC, o.count DESC LIMIT ?
+            """, (fresh_after, max(1, self.prewarm_min_selections), self.prewarm_top)).fetchall()
+        return [title for (title,) in rows]
+
+    def start_prewarm(self, generate):
+        if self.prewarm_top <= 0:
+            return
+        threading.Thread(target=self._prewarm_loop, args=(generate,), name="recipe-prewarm", daemon=True).start()
+
+    def _prewarm_loop(self, generate):
+        while True:
+            # 複数ワーカーで同時に走らないよう少しずらす
+            time.sleep(self.prewarm_interval * random.uniform(0.5, 1.5))
+            for title in self.titles_to_prewarm():
+                try:
+                    self.get_or_create(title, generate, refresh_before=self.refresh_before)
+                except Exception as e:
+                    print(f"❌ プリウォーム失敗: {title}: {e}")
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses, "coalesced": self.coalesced}
@@ -0,0 +1,132 @@
+# GPTへのプロンプト生成・応答のパース・Flexの中身づくり。Flask版(main.py)とASGI版(asgi.py)で共通。
+import re
+
+def detect_category(user_msg):
+    if "スイーツ" in user_msg or "デザート" in user_msg:
+        return "Japanese desserts"
+    elif "ドリンク" in user_msg or "飲み物" in user_msg:
+        return "Japanese drinks"
+    return "Japanese meals"
+
+def generate_recipe_prompt(user_msg):
+    category = detect_category(user_msg)
+
+    prompt = f"""
+The user says: "{user_msg}"
+Please suggest 5 {category} based on this mood.
+
+Respond with a single JSON object only, with the keys in exactly this order:
+{{"summary": "...", "items": [{{"title": "...", "reason": "..."}}, ...]}}
+- summary: one overall summary sentence (1 short line) about the general theme of the suggestions, such as "These recipes are refreshing and help cool down on a hot day."
+- items: exactly 5 suggestions
+  - title: the dish name only, without numbers
+  - reason: a brief reason why it fits the mood
+
+Write all values only in Japanese.
+Avoid generic items like coffee, udon, or somen unless user asked.
+Avoid drinks or desserts unless requested.
+Use common ingredients and simple ideas, but make at least one feel new or clever.
+"""
+    return prompt
+
+def generate_detail_prompt(title):
+    return f"""
+You are a Japanese cooking expert. Please write a full recipe for the following item.
+
+【Dish】{title}
+
+Language rules:
+- If the title is in Japanese, respond entirely in Japanese.
+- If the title is in English, respond entirely in English.
+
+Recipe should include:
+
+1. How many servings it makes (e.g., 2〜3人前)
+2. List of ingredients using simple units:
+   - Use friendly measurements like "a little", "1 handful", "1 piece"
+   - Avoid using grams (g), milliliters (ml), or complex cooking terms
+3. Step-by-step instructions (max 7 steps):
+   - Add brief explanations **only where it's especially helpful or interesting**
+     (e.g., "Start with skin side down to make it crispy")
+   - If the recipe allows shortcuts (e.g., pre-made tempura for tendon), include that as an option
+4. At the end, include a fun or useful fact about the dish
+   - Make it light and friendly
+   - Start with one of the following headers (choose randomly): 
+     「料理の小ネタ」, 「知ってると話したくなる話」, 「この料理、実は…」, 「ちょこっと豆知識」, 「豆メモ」
+
+This rule applies to:
+- Meals
+- Desserts (スイーツ / sweets)
+- Drinks (ドリンク / beverages)
+
+Be concise, clear, and beginner-friendly.
+"""
+
+def parse_recipes(content):
+    lines = content.split("\n")
+    recipes = []
+    for line in lines:
+        if line.strip() == "":
+            continue
+        if line[0].isdigit():
+            parts = line.split("：", 1) if "：" in line else line.split(":", 1)
+            if len(parts) > 1:
+                title = parts[1].strip().split("。", 1)[0].split(".", 1)[0]
+            else:
+                title = parts[0].strip()
+            recipes.append({"title": title, "reason": ""})
+        elif recipes:
+            recipes[-1]["reason"] += line.strip() + " "
+
+    # Remove trailing whitespace from reason
+    for r in recipes:
+        r["reason"] = r["reason"].strip()
+    return recipes
+
+
+def build_flex_bubble(user_msg, recipes):
+    seen_titles = set()
+    buttons = []
+
+    for i, item in enumerate(recipes):
+        raw_title = item.get("title", "レシピ").strip()
+        # 先頭の番号・句読点（例: 1. 明太子パスタ）を除去
+        title = re.sub(r"^[0-9]+[.:：\\s]*", "", raw_title)[:20]
+
+        if not title or title in seen_titles:
+            continue
+        seen_titles.add(title)
+
+        buttons.append({
+            "type": "button",
+            "action": {
+                "type": "message",
+                "label": f"{i+1}. {title}",
+                "text": f"{i+1}"
+            },
+            "style": "primary",
+            "margin": "sm"
+        })
+
+    return {
+        "type": "bubble",
+        "body": {
+            "type": "box",
+            "layout": "vertical",
+            "contents": [
+                {
+                    "type": "text",
+                    "text": f"「{user_msg}」にぴったりなレシピ、選んでね👇",
+                    "weight": "bold",
+                    "size": "md",
+                    "wrap": True
+                }
+            ]
+        },
+        "footer": {
+            "type": "box",
+            "layout": "vertical",
+            "spacing": "sm",
+            "contents": buttons
+        }
+    }
@@ -0,0 +1,168 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# ユーザーごとの状態（提案中のレシピ一覧、利用回数など）を置く場所。キーごとに有効期限を持つ。
+# MemorySessionStore: 1プロセス内だけで使う。速い。
+# SqliteSessionStore: SQLite(WAL)ファイルを複数のgunicornワーカーで共有する。
+# どちらも値はJSONにして持つので、取り出した値を書き換えても保存済みの値は変わらない。
+# 期限切れのキーは読むときに無視され、バックグラウンドのスイープで消える。
+
+
+def _pack(value):
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def _unpack(data):
+    return json.loads(data)
+
+
+class _Record:
+    __slots__ = ("data", "expires")
+
+    def __init__(self, data, expires):
+        self.data = data
+        self.expires = expires
+
+
+class MemorySessionStore:
+    def __init__(self, ttl=86400, sweep_interval=60):
+        self.ttl = ttl
+        self._records = {}
+        self._lock = threading.Lock()
+        _start_sweeper(self, sweep_interval)
+
+    def get(self, key, default=None):
+        record = self._records.get(key)
+        if record is None or record.expires <= time.time():
+            return default
+        return _unpack(record.data)
+
+    def set(self, key, value, ttl=None):
+        record = _Record(_pack(value), time.time() + (ttl or self.ttl))
+        with self._lock:
+            self._records[key] = record
+
+    def delete(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+
+    def update(self, key, func, default=None, ttl=None):
+        # 読んで書き換えて保存するまでを、他のスレッドに割り込まれずに行う
+        now = time.time()
+        with self._lock:
+            record = self._records.get(key)
+            value = default if record is None or record.expires <= now else _unpack(record.data)
+            value = func(value)
+            self._records[key] = _Record(_pack(value), now + (ttl or self.ttl))
+        return value
+
+    def sweep(self, batch=10000):
+        now = time.time()
+        expired = [key for key, record in list(self._records.items()) if record.expires <= now]
+        for i in range(0, len(expired), batch):
+            with self._lock:
+                for key in expired[i:i + batch]:
+                    record = self._records.get(key)
+                    if record is not None and record.expires <= now:
+                        del self._records[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._records)
+
+
+class SqliteSessionStore:
+    def __init__(self, path, table="sessions", ttl=86400, sweep_interval=60):
+        self.path = path
+        self.table = table
+        self.ttl = ttl
+        self._local = threading.local()
+        self._conn().execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires REAL NOT NULL
+            ) WITHOUT ROWID
+        """)
+        self._conn().execute(f"CREATE INDEX IF NOT EXISTS {table}_expires ON {table} (expires)")
+        _start_sweeper(self, sweep_interval)
+
+    def _conn(self):
+        # sqlite3 の接続はスレッドをまたげないので、スレッドごとに開く
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        row = self._conn().execute(
+            f"SELECT value FROM {self.table} WHERE key = ? AND expires > ?",
+            (key, time.time()),
+        ).fetchone()
+        return default if row is None else _unpack(row[0])
+
+    def set(self, key, value, ttl=None):
+        self._conn().execute(
+            f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+            (key, _pack(value), time.time() + (ttl or self.ttl)),
+        )
+
+    def delete(self, key):
+        self._conn().execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def update(self, key, func, default=None, ttl=None):
+        # BEGIN IMMEDIATE で書き込みロックを先に取り、他のワーカーとの競合を防ぐ
+        conn = self._conn()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            row = conn.execute(
+                f"SELECT value FROM {self.table} WHERE key = ? AND expires > ?",
+                (key, now),
+            ).fetchone()
+            value = func(default if row is None else _unpack(row[0]))
+            conn.execute(
+                f"INSERT OR REPLACE INTO {self.table} VALUES (?, ?, ?)",
+                (key, _pack(value), now + (ttl or self.ttl)),
+            )
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        return value
+
+    def sweep(self):
+        return self._conn().execute(
+            f"DELETE FROM {self.table} WHERE expires <= ?", (time.time(),)
+        ).rowcount
+
+    def __len__(self):
+        return self._conn().execute(f"SELECT COUNT(*) FROM {self.table}").fetchone()[0]
+
+
+def _start_sweeper(store, interval):
+    if interval <= 0:
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                store.sweep()
+            except Exception as e:
+                print(f"❌ セッションの掃除に失敗: {e}")
+
+    threading.Thread(target=run, name="session-sweeper", daemon=True).start()
+
+
+def open_store(table, ttl):
+    # 標準は複数ワーカーで共有できる SQLite。SESSION_STORE=memory で1プロセス内だけに持つ
+    if os.environ.get("SESSION_STORE", "sqlite") == "sqlite":
+        return SqliteSessionStore(os.environ.get("SESSION_DB", "sessions.db"), table=table, ttl=ttl)
+    return MemorySessionStore(ttl=ttl)
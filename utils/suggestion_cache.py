@@ -0,0 +1,130 @@
+import json
+import random
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from utils.recipes import detect_category
+
+# 気分テキスト → 5件の提案リストのキャッシュ。SQLiteに保存するので再起動しても残る。
+# 同じキーに最大 variants 件の提案を持ち、ヒット時はその中からランダムに返す（順番もシャッフル）。
+# 件数が足りないうちは refresh_rate の確率でわざとミスにして、別の提案を集める。
+
+
+def normalize_mood(text):
+    # 全角/半角・大文字/小文字・カタカナ/ひらがなの違い、記号や空白、絵文字を無視する
+    text = unicodedata.normalize("NFKC", text).lower()
+    chars = []
+    for ch in text:
+        if "ァ" <= ch <= "ヶ":
+            ch = chr(ord(ch) - 0x60)
+        if unicodedata.category(ch)[0] in ("P", "S", "Z", "C"):
+            continue
+        # 「あつーーい」「さっぱりぃぃ」のような伸ばしは1文字にまとめる
+        if chars and ch == chars[-1] and ch in "ーぃぁぅぇぉっ〜":
+            continue
+        chars.append(ch)
+    return "".join(chars).rstrip("ー〜っ")
+
+
+def mood_key(user_msg):
+    # 絵文字や記号だけのメッセージは正規化すると空になり、別々の気分が同じキーになるのでキャッシュしない(None)
+    mood = normalize_mood(user_msg)
+    if not mood:
+        return None
+    return f"{detect_category(user_msg)}|{mood}"
+
+
+class SuggestionCache:
+    def __init__(self, path=":memory:", ttl=6 * 3600, max_entries=5000, variants=3, refresh_rate=0.1):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.variants = variants
+        self.refresh_rate = refresh_rate
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS suggestions (
+                key TEXT NOT NULL,
+                variant INTEGER NOT NULL,
+                recipes TEXT NOT NULL,
+                summary TEXT NOT NULL,
+                tokens INTEGER NOT NULL,
+                latency REAL NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                PRIMARY KEY (key, variant)
+            )
+        """)
+        self._db.execute("CREATE INDEX IF NOT EXISTS suggestions_accessed ON suggestions (accessed)")
+        self.hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self.tokens_saved = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT variant, recipes, summary, tokens, latency FROM suggestions"
+                " WHERE key = ? AND created > ?",
+                (key, now - self.ttl),
+            ).fetchall()
+            if not rows or (len(rows) < self.variants and random.random() < self.refresh_rate):
+                self.misses += 1
+                return None
+            variant, recipes, summary, tokens, latency = random.choice(rows)
+            self._db.execute(
+                "UPDATE suggestions SET accessed = ? WHERE key = ? AND variant = ?",
+                (now, key, variant),
+            )
+            self.hits += 1
+            self.latency_saved += latency
+            self.tokens_saved += tokens
+        recipes = json.loads(recipes)
+        random.shuffle(recipes)
+        return recipes, summary
+
+    def put(self, key, recipes, summary="", tokens=0, latency=0.0):
+        now = time.time()
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT variant, created FROM suggestions WHERE key = ? ORDER BY created",
+                (key,),
+            ).fetchall()
+            used = {variant for variant, _ in rows}
+            free = [v for v in range(self.variants) if v not in used]
+            # 空きがなければ一番古い提案を入れ替える
+            variant = free[0] if free else rows[0][0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO suggestions VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (key, variant, json.dumps(recipes, ensure_ascii=False), summary,
+                 tokens, latency, now, now),
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        self._db.execute("DELETE FROM suggestions WHERE created <= ?", (now - self.ttl,))
+        # キー数が上限を超えたら、最後に使われたのが古いキーから消す
+        overflow = self._db.execute(
+            "SELECT COUNT(DISTINCT key) FROM suggestions"
+        ).fetchone()[0] - self.max_entries
+        if overflow > 0:
+            self._db.execute("""
+                DELETE FROM suggestions WHERE key IN (
+                    SELECT key FROM suggestions GROUP BY key
+                    ORDER BY MAX(accessed) LIMIT ?
+                )
+            """, (overflow,))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "latency_saved_seconds": self.latency_saved,
+            "tokens_saved": self.tokens_saved,
+        }
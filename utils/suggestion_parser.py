@@ -0,0 +1,108 @@
+from utils.recipes import parse_recipes
+
+# GPTのJSON応答 {"summary": ..., "items": [{"title": ..., "reason": ...}, ...]} を、
+# ストリームで届いた分から少しずつ読むパーサー。
+# 5件目の title が読めた時点で ready() が True になり、理由の続きを待たずにFlexを送れる。
+# JSONとして読めなかったときは、これまでの行分割パーサー(parse_recipes)で読み直す（再リクエストはしない）。
+
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class SuggestionStreamParser:
+    def __init__(self, expected=5):
+        self.expected = expected
+        self.summary = ""
+        self.items = []
+        self.text = []
+        self._started = False
+        # [True, キー, キー待ちか] / [False, 添字]
+        self._stack = []
+        self._in_string = False
+        self._escape = None
+        self._buf = []
+
+    def feed(self, chunk):
+        self.text.append(chunk)
+        for ch in chunk:
+            if self._in_string:
+                self._read_string(ch)
+            elif not self._started:
+                # ```json などの前置きは読み飛ばす
+                if ch == "{":
+                    self._started = True
+                    self._stack.append([True, None, True])
+            elif self._stack:
+                self._read_structure(ch)
+
+    def _read_string(self, ch):
+        if self._escape is not None:
+            self._escape += ch
+            if self._escape[0] != "u":
+                self._buf.append(_ESCAPES.get(self._escape, self._escape))
+                self._escape = None
+            elif len(self._escape) == 5:
+                try:
+                    self._buf.append(chr(int(self._escape[1:], 16)))
+                except ValueError:
+                    pass
+                self._escape = None
+        elif ch == "\\":
+            self._escape = ""
+        elif ch == '"':
+            self._in_string = False
+            self._on_string("".join(self._buf))
+        else:
+            self._buf.append(ch)
+
+    def _read_structure(self, ch):
+        top = self._stack[-1]
+        if ch == '"':
+            self._in_string = True
+            self._buf = []
+        elif ch == "{":
+            self._stack.append([True, None, True])
+        elif ch == "[":
+            self._stack.append([False, 0])
+        elif ch in "}]":
+            self._stack.pop()
+        elif ch == ",":
+            if top[0]:
+                top[2] = True
+            else:
+                top[1] += 1
+        elif ch == ":" and top[0]:
+            top[2] = False
+
+    def _on_string(self, value):
+        top = self._stack[-1]
+        if top[0] and top[2]:
+            top[1] = value
+            return
+        path = [entry[1] for entry in self._stack]
+        if path == ["summary"]:
+            self.summary = value.strip()
+        elif len(path) == 3 and path[0] == "items" and path[2] in ("title", "reason"):
+            index = path[1]
+            while len(self.items) <= index:
+                self.items.append({"title": "", "reason": ""})
+            self.items[index][path[2]] = value.strip()
+
+    def ready(self):
+        # 空の title は suggestions() で落とすので、使える件数で数える
+        return len(self.suggestions()) >= self.expected
+
+    def suggestions(self):
+        return [item for item in self.items if item["title"]][:self.expected]
+
+    def finish(self):
+        # ストリームが終わったら (提案リスト, サマリー) を返す
+        suggestions = self.suggestions()
+        if suggestions:
+            return suggestions, self.summary
+
+        recipes = parse_recipes("".join(self.text).strip())
+        suggestions = recipes[:5]
+        summary_line = ""
+        if recipes and recipes[-1]['reason'].startswith("全体の傾向："):
+            summary_line = recipes.pop()['reason'].replace("全体の傾向：", "")
+        return suggestions, summary_line
@@ -1,17 +1,43 @@
-from datetime import datetime
-from collections import defaultdict
+import os
+from utils.rate_limiter import TokenBucket, RateLimited
+from utils.session_store import open_store
 
-# user_id -> [日付, 回数]
-usage_log = defaultdict(lambda: ["", 0])
+# 1ユーザーあたり1日 USER_DAILY_LIMIT 回まで提案する（24時間かけて少しずつ回復）
+user_quota = TokenBucket(
+    open_store("usage", ttl=86400),
+    capacity=int(os.environ.get("USER_DAILY_LIMIT", "5")),
+    per_seconds=86400,
+)
 
-def check_usage(user_id):
-    today = datetime.now().strftime("%Y-%m-%d")
-    last_date, count = usage_log[user_id]
+# OpenAI 全体の予算。429 を食らう前に手元で断る
+openai_requests = TokenBucket(
+    open_store("openai_rpm", ttl=60),
+    capacity=int(os.environ.get("OPENAI_RPM", "3500")),
+    per_seconds=60,
+)
+openai_tokens = TokenBucket(
+    open_store("openai_tpm", ttl=60),
+    capacity=int(os.environ.get("OPENAI_TPM", "90000")),
+    per_seconds=60,
+)
+# 実際の使用量は応答が来るまで分からないので、まずこの見積もりで予約する
+ESTIMATED_TOKENS = int(os.environ.get("OPENAI_ESTIMATED_TOKENS", "1000"))
 
-    if last_date != today:
-        usage_log[user_id] = [today, 0]
+def consume_usage(user_id):
+    return user_quota.consume(user_id)
 
-    return usage_log[user_id][1] < 5
+def refund_usage(user_id):
+    # 混雑で断ったときは、その回を数えない
+    user_quota.refund(user_id, 1)
 
-def increment_usage(user_id):
-    usage_log[user_id][1] += 1
+def reserve_openai(tokens=ESTIMATED_TOKENS):
+    if not openai_requests.consume("global"):
+        raise RateLimited("OpenAI requests per minute budget exhausted")
+    if not openai_tokens.consume("global", tokens):
+        openai_requests.refund("global", 1)
+        raise RateLimited("OpenAI tokens per minute budget exhausted")
+
+def settle_openai(used_tokens, reserved=ESTIMATED_TOKENS):
+    # used_tokens が None（使った量が分からない）なら見積もりのまま。0 なら予約を全部戻す
+    if used_tokens is not None:
+        openai_tokens.refund("global", reserved - used_tokens)